@@ -0,0 +1,493 @@
+"""CPU benchmark of the models and training loops of modules 21-26.
+
+Every case rebuilds one of the course models and trains it for a fixed number
+of steps with the same kind of loop as the notebook it comes from: `train`
+from module21, `train_epoch` (also used by `train` and `train_long`) from
+module22, `model.fit` from modules 24 and 25, and `fit_one_batch` from
+module26, both eagerly and as a `tf.function`. The inputs are random tensors
+of the right shapes, so nothing is downloaded and the time spent loading data
+is not part of the measurement.
+
+Each case runs in its own Python process, so that its peak memory use and its
+thread pools are not affected by the other cases or by the other framework.
+The report records, for every case, the samples per second, the distribution
+of the step latency, the peak resident memory and the number of threads, and
+is compared with a stored baseline: cases that got slower than the baseline by
+more than `--tolerance` are reported as regressions and make the script exit
+with status 1, as do cases that fail. Cases whose framework isn't installed
+are skipped.
+
+Usage:
+
+    python benchmarks/benchmark.py                      # all cases, compared with benchmarks/baseline.json
+    python benchmarks/benchmark.py --cases 'module22-*' --steps 50
+    python benchmarks/benchmark.py --save-baseline      # store this run as the new baseline
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+FRAMEWORK_MODULES = ('torch', 'torchvision', 'tensorflow')
+SKIPPED_EXIT_STATUS = 3
+
+
+# Memory and threads, read from /proc on Linux.
+
+def _status(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM (the peak RSS) to the current RSS.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    kb = _status('VmHWM')
+    if kb is not None:
+        return kb / 1024
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def thread_count():
+    return _status('Threads')
+
+
+def latency_stats(latencies, batch_size):
+    # quantiles needs at least two values; with a single step every percentile is that step.
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'samples_per_sec': batch_size * len(latencies) / sum(latencies),
+        'step_ms': {
+            'mean': 1000 * statistics.fmean(latencies),
+            'p50': 1000 * percentiles[49],
+            'p90': 1000 * percentiles[89],
+            'p99': 1000 * percentiles[98],
+            'max': 1000 * max(latencies),
+        },
+    }
+
+
+# PyTorch cases
+
+def _torch_models():
+    import torch
+    from torch import nn
+    import torch.nn.functional as F
+
+    class NeuralNetwork(nn.Module):  # module21, full-process
+        def __init__(self):
+            super(NeuralNetwork, self).__init__()
+            self.flatten = nn.Flatten()
+            self.linear_relu_stack = nn.Sequential(
+                nn.Linear(28*28, 512), nn.ReLU(), nn.Linear(512, 512), nn.ReLU(), nn.Linear(512, 10), nn.ReLU())
+
+        def forward(self, x):
+            return self.linear_relu_stack(self.flatten(x))
+
+    class MultiLayerCNN(nn.Module):  # module22, multilayer-convolutions
+        def __init__(self):
+            super(MultiLayerCNN, self).__init__()
+            self.conv1 = nn.Conv2d(1, 10, 5)
+            self.pool = nn.MaxPool2d(2, 2)
+            self.conv2 = nn.Conv2d(10, 20, 5)
+            self.fc = nn.Linear(320, 10)
+
+        def forward(self, x):
+            x = self.pool(F.relu(self.conv1(x)))
+            x = self.pool(F.relu(self.conv2(x)))
+            return F.log_softmax(self.fc(torch.flatten(x, 1)), dim=1)
+
+    class LeNet(nn.Module):  # module22, multilayer-convolutions
+        def __init__(self):
+            super(LeNet, self).__init__()
+            self.conv1 = nn.Conv2d(3, 6, 5)
+            self.pool = nn.MaxPool2d(2)
+            self.conv2 = nn.Conv2d(6, 16, 5)
+            self.conv3 = nn.Conv2d(16, 120, 5)
+            self.flat = nn.Flatten()
+            self.fc1 = nn.Linear(120, 64)
+            self.fc2 = nn.Linear(64, 10)
+
+        def forward(self, x):
+            x = self.pool(F.relu(self.conv1(x)))
+            x = self.pool(F.relu(self.conv2(x)))
+            x = F.relu(self.conv3(x))
+            x = F.relu(self.fc1(self.flat(x)))
+            return self.fc2(x)
+
+    def mobilenet_head():  # module22, mobilenet: frozen features, new classifier
+        import torchvision
+        model = torchvision.models.mobilenet_v2(weights=None)
+        for p in model.parameters():
+            p.requires_grad = False
+        model.classifier = nn.Linear(1280, 2)
+        return model
+
+    return {
+        'NeuralNetwork': NeuralNetwork,
+        'Perceptron': lambda: nn.Sequential(nn.Flatten(), nn.Linear(784, 10), nn.LogSoftmax(dim=1)),
+        'MultiLayerPerceptron': lambda: nn.Sequential(nn.Flatten(), nn.Linear(784, 100), nn.ReLU(),
+                                                      nn.Linear(100, 10), nn.LogSoftmax(dim=1)),
+        'MultiLayerCNN': MultiLayerCNN,
+        'LeNet': LeNet,
+        'MobileNetV2Head': mobilenet_head,
+    }
+
+
+def _torch_step(loop, model, loss_fn, optimizer):
+    import torch
+
+    if loop == 'train':
+        # module21 `train`: loss, then zero_grad, backward and step.
+        def step(X, y):
+            pred = model(X)
+            loss = loss_fn(pred, y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            return loss
+        return step
+
+    # module22 `train_epoch` (and `train`, `train_long`): also accumulates the loss and accuracy.
+    totals = {'loss': 0, 'acc': 0}
+
+    def step(X, y):
+        optimizer.zero_grad()
+        out = model(X)
+        loss = loss_fn(out, y)
+        loss.backward()
+        optimizer.step()
+        totals['loss'] += loss
+        _, predicted = torch.max(out, 1)
+        totals['acc'] += (predicted == y).sum()
+        return loss
+    return step
+
+
+def run_torch_case(case, steps, warmup_steps):
+    import torch
+    from torch import nn
+
+    torch.manual_seed(0)
+    model = _torch_models()[case['model']]()
+    model.train()
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=1e-3) if case['optimizer'] == 'sgd' else torch.optim.Adam(params, lr=0.01)
+    loss_fn = nn.CrossEntropyLoss() if case['loss'] == 'cross_entropy' else nn.NLLLoss()
+    step = _torch_step(case['loop'], model, loss_fn, optimizer)
+
+    batch_size = case['batch_size']
+    batches = [(torch.rand(batch_size, *case['input_shape']), torch.randint(0, case['classes'], (batch_size,)))
+               for _ in range(4)]
+    for i in range(warmup_steps):
+        step(*batches[i % len(batches)])
+
+    reset_peak_rss()
+    latencies = []
+    for i in range(steps):
+        begin = time.perf_counter()
+        step(*batches[i % len(batches)]).item()  # .item() waits for the step to finish
+        latencies.append(time.perf_counter() - begin)
+
+    result = latency_stats(latencies, batch_size)
+    result.update({'peak_rss_mb': peak_rss_mb(), 'threads': thread_count(),
+                   'intra_op_threads': torch.get_num_threads(), 'inter_op_threads': torch.get_num_interop_threads(),
+                   'version': torch.__version__})
+    return result
+
+
+# TensorFlow cases
+
+def _tf_models():
+    import tensorflow as tf
+    keras = tf.keras
+
+    class NeuralNetwork(keras.Model):  # module24, neural-network
+        def __init__(self):
+            super(NeuralNetwork, self).__init__()
+            self.sequence = keras.Sequential([
+                keras.layers.Flatten(input_shape=(28, 28)),
+                keras.layers.Dense(20, activation='relu'),
+                keras.layers.Dense(10)])
+
+        def call(self, x):
+            return self.sequence(x)
+
+    class LowLevelNetwork(keras.Model):  # module26, model
+        def __init__(self):
+            super(LowLevelNetwork, self).__init__()
+            initializer = keras.initializers.GlorotUniform()
+            self.W1 = tf.Variable(initializer(shape=(784, 20)))
+            self.b1 = tf.Variable(tf.zeros(shape=(20,)))
+            self.W2 = tf.Variable(initializer(shape=(20, 10)))
+            self.b2 = tf.Variable(tf.zeros(shape=(10,)))
+
+        def call(self, x):
+            x = tf.nn.relu(tf.matmul(tf.reshape(x, [-1, 784]), self.W1) + self.b1)
+            return tf.matmul(x, self.W2) + self.b2
+
+    return {
+        'NeuralNetwork': NeuralNetwork,
+        'LowLevelNetwork': LowLevelNetwork,
+        'MultiLayerDense': lambda: keras.models.Sequential([  # module25, multilayer-dense-neural-networks
+            keras.layers.Flatten(input_shape=(28, 28)),
+            keras.layers.Dense(100, activation='relu'),
+            keras.layers.Dense(10)]),
+        'MultiLayerCNN': lambda: keras.models.Sequential([  # module25, convolutional-networks
+            keras.layers.Conv2D(filters=10, kernel_size=(5, 5), input_shape=(28, 28, 1), activation='relu'),
+            keras.layers.MaxPooling2D(),
+            keras.layers.Conv2D(filters=20, kernel_size=(5, 5), activation='relu'),
+            keras.layers.MaxPooling2D(),
+            keras.layers.Flatten(),
+            keras.layers.Dense(10)]),
+        'LeNet': lambda: keras.models.Sequential([  # module25, convolutional-networks (CIFAR-10)
+            keras.layers.Conv2D(filters=6, kernel_size=5, activation='relu', input_shape=(32, 32, 3)),
+            keras.layers.MaxPooling2D(pool_size=2, strides=2),
+            keras.layers.Conv2D(filters=16, kernel_size=5, activation='relu'),
+            keras.layers.MaxPooling2D(pool_size=2, strides=2),
+            keras.layers.Flatten(),
+            keras.layers.Dense(120, activation='relu'),
+            keras.layers.Dense(84, activation='relu'),
+            keras.layers.Dense(10)]),
+    }
+
+
+def run_tf_case(case, steps, warmup_steps):
+    import tensorflow as tf
+
+    tf.random.set_seed(0)
+    model = _tf_models()[case['model']]()
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    optimizer = tf.keras.optimizers.SGD(0.1)
+    batch_size = case['batch_size']
+    X = tf.random.uniform((batch_size, *case['input_shape']))
+    y = tf.random.uniform((batch_size,), maxval=case['classes'], dtype=tf.int64)
+
+    if case['loop'] == 'fit':
+        class StepTimer(tf.keras.callbacks.Callback):
+            def on_train_batch_begin(self, batch, logs=None):
+                self.begin = time.perf_counter()
+
+            def on_train_batch_end(self, batch, logs=None):
+                latencies.append(time.perf_counter() - self.begin)
+
+        model.compile(optimizer, loss_fn, metrics=['accuracy'])
+        dataset = tf.data.Dataset.from_tensors((X, y)).repeat()
+        model.fit(dataset, epochs=1, steps_per_epoch=max(warmup_steps, 1), verbose=0)
+        reset_peak_rss()
+        latencies = []
+        # Keras waits for the result of each step before calling batch hooks, so StepTimer times whole steps.
+        model.fit(dataset, epochs=1, steps_per_epoch=steps, verbose=0, callbacks=[StepTimer()])
+    else:
+        # module26 `fit_one_batch`, run eagerly or as a tf.function.
+        def fit_one_batch(X, y):
+            with tf.GradientTape() as tape:
+                y_prime = model(X, training=True)
+                loss = loss_fn(y, y_prime)
+            grads = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            return y_prime, loss
+
+        if case['loop'] == 'tf.function':
+            fit_one_batch = tf.function(fit_one_batch)
+        for _ in range(max(warmup_steps, 1)):
+            fit_one_batch(X, y)
+        reset_peak_rss()
+        latencies = []
+        for _ in range(steps):
+            begin = time.perf_counter()
+            fit_one_batch(X, y)[1].numpy()
+            latencies.append(time.perf_counter() - begin)
+
+    result = latency_stats(latencies, batch_size)
+    result.update({'peak_rss_mb': peak_rss_mb(), 'threads': thread_count(),
+                   'intra_op_threads': tf.config.threading.get_intra_op_parallelism_threads(),
+                   'inter_op_threads': tf.config.threading.get_inter_op_parallelism_threads(),
+                   'version': tf.__version__})
+    return result
+
+
+def _case(framework, model, loop, input_shape, batch_size=64, classes=10, **options):
+    return dict(framework=framework, model=model, loop=loop, input_shape=input_shape,
+                batch_size=batch_size, classes=classes, **options)
+
+
+CASES = {
+    'module21-mlp-train': _case('torch', 'NeuralNetwork', 'train', (1, 28, 28), optimizer='sgd', loss='cross_entropy'),
+    'module22-perceptron-train_epoch': _case('torch', 'Perceptron', 'train_epoch', (1, 28, 28), optimizer='adam', loss='nll'),
+    'module22-mlp-train_epoch': _case('torch', 'MultiLayerPerceptron', 'train_epoch', (1, 28, 28), optimizer='adam', loss='nll'),
+    'module22-cnn-train_epoch': _case('torch', 'MultiLayerCNN', 'train_epoch', (1, 28, 28), optimizer='adam', loss='nll'),
+    'module22-lenet-train_epoch': _case('torch', 'LeNet', 'train_epoch', (3, 32, 32), optimizer='adam', loss='cross_entropy'),
+    'module22-mobilenet-train_long': _case('torch', 'MobileNetV2Head', 'train_epoch', (3, 224, 224), batch_size=16,
+                                           classes=2, optimizer='adam', loss='cross_entropy', steps=20),
+    'module24-mlp-fit': _case('tf', 'NeuralNetwork', 'fit', (28, 28)),
+    'module25-mlp-fit': _case('tf', 'MultiLayerDense', 'fit', (28, 28)),
+    'module25-cnn-fit': _case('tf', 'MultiLayerCNN', 'fit', (28, 28, 1)),
+    'module25-lenet-fit': _case('tf', 'LeNet', 'fit', (32, 32, 3)),
+    'module26-fit-eager': _case('tf', 'LowLevelNetwork', 'eager', (28, 28)),
+    'module26-fit-tf.function': _case('tf', 'LowLevelNetwork', 'tf.function', (28, 28)),
+}
+
+
+def run_case(name, steps, warmup_steps):
+    """Run one case in this process and return its result."""
+    case = CASES[name]
+    steps = min(steps, case.get('steps', steps))
+    run = run_torch_case if case['framework'] == 'torch' else run_tf_case
+    result = run(case, steps, warmup_steps)
+    result.update({'framework': case['framework'], 'loop': case['loop'], 'batch_size': case['batch_size'], 'steps': steps})
+    return result
+
+
+def run_case_main(name, steps, warmup_steps):
+    """Entry point of the case process: prints the result, or the missing framework with a distinct exit status."""
+    try:
+        result = run_case(name, steps, warmup_steps)
+    except ModuleNotFoundError as e:
+        if (e.name or '').split('.')[0] not in FRAMEWORK_MODULES:
+            raise
+        print(json.dumps({'skipped': f'{e.name} is not installed'}))
+        return SKIPPED_EXIT_STATUS
+    print(json.dumps(result))
+    return 0
+
+
+def run_isolated(name, steps, warmup_steps, timeout=1800):
+    """Run one case in a new Python process.
+
+    A case whose framework isn't installed is marked as skipped; a case that
+    fails in any other way, or times out, is marked as an error.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-case', name,
+           '--steps', str(steps), '--warmup-steps', str(warmup_steps)]
+    env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL='2', CUDA_VISIBLE_DEVICES='-1')
+    framework = CASES[name]['framework']
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout, env=env)
+    except subprocess.TimeoutExpired:
+        return {'framework': framework, 'error': f'timed out after {timeout} s'}
+    if proc.returncode == SKIPPED_EXIT_STATUS:
+        return dict(json.loads(proc.stdout.strip().splitlines()[-1]), framework=framework)
+    if proc.returncode != 0:
+        error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit status {proc.returncode}'
+        return {'framework': framework, 'error': error}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare(report, baseline, tolerance):
+    """Names of the cases whose throughput or median step time is worse than the baseline by more than `tolerance`."""
+    regressions = []
+    for name, result in report['cases'].items():
+        base = baseline.get('cases', {}).get(name)
+        if base is None or 'samples_per_sec' not in result or 'samples_per_sec' not in base:
+            continue
+        slower = result['samples_per_sec'] < base['samples_per_sec'] * (1 - tolerance)
+        higher = result['step_ms']['p50'] > base['step_ms']['p50'] * (1 + tolerance)
+        if slower or higher:
+            regressions.append(name)
+    return regressions
+
+
+def print_table(report, baseline):
+    print(f"{'case':34} {'samples/s':>10} {'vs base':>8} {'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>8} {'threads':>7}")
+    for name, result in report['cases'].items():
+        if 'skipped' in result or 'error' in result:
+            status = 'skipped' if 'skipped' in result else 'error'
+            print(f"{name:34} {status}: {result[status]}")
+            continue
+        base = baseline.get('cases', {}).get(name, {})
+        change = (f"{result['samples_per_sec'] / base['samples_per_sec'] - 1:+.0%}"
+                  if 'samples_per_sec' in base else '')
+        rss = '-' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f}"
+        print(f"{name:34} {result['samples_per_sec']:10.0f} {change:>8} {result['step_ms']['p50']:8.2f} "
+              f"{result['step_ms']['p99']:8.2f} {rss:>8} {result['threads'] or '':>7}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CPU benchmark of the training loops of modules 21-26.')
+    parser.add_argument('--cases', nargs='+', default=['*'], help='case names or glob patterns (default: all)')
+    parser.add_argument('--steps', type=int, default=200, help='measured training steps per case (default: 200)')
+    parser.add_argument('--warmup-steps', type=int, default=5, help='steps run before measuring (default: 5)')
+    parser.add_argument('--output', default='benchmark-report.json', help='report file (default: benchmark-report.json)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline report to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='store this report as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed slowdown relative to the baseline (default: 0.10)')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        return run_case_main(args.run_case, args.steps, args.warmup_steps)
+    names = [name for name in CASES if any(fnmatch.fnmatch(name, pattern) for pattern in args.cases)]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'node': platform.node(), 'machine': platform.machine(), 'processor': platform.processor(),
+                 'cpu_count': os.cpu_count(), 'python': platform.python_version()},
+        'steps': args.steps,
+        'cases': {},
+    }
+    for name in names:
+        print(f'Running {name}...', file=sys.stderr)
+        report['cases'][name] = run_isolated(name, args.steps, args.warmup_steps)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('host', {}).get('node') != report['host']['node']:
+            print(f"Note: the baseline was recorded on {baseline.get('host', {}).get('node')}, not on this host",
+                  file=sys.stderr)
+    print_table(report, baseline)
+
+    errors = [name for name, result in report['cases'].items() if 'error' in result]
+    for name in errors:
+        print(f'Error: {name} failed')
+    if errors:
+        if args.save_baseline:
+            print('Baseline not saved, because some cases failed')
+        return 1
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    regressions = compare(report, baseline, args.tolerance)
+    for name in regressions:
+        print(f'Regression: {name} is more than {args.tolerance:.0%} slower than the baseline')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""Compiled training step for CPU training.
+
+`make_train_step` wraps the forward pass, the loss, the backward pass and the
+optimizer step into one callable, either eager (the reference), traced with
+TorchScript, or compiled with `torch.compile`. `enable_persistent_cache` keeps
+the code generated by `torch.compile` on disk, so that a restarted kernel
+reuses it instead of compiling again, and `benchmark` compares the steps per
+second of each mode.
+
+`torch.compile` is not supported everywhere, for example not on Windows or
+with Python 3.11 in PyTorch 2.0. There, `make_train_step` falls back to the
+eager step and `benchmark` skips the `'compile'` mode.
+"""
+import copy
+import os
+import time
+
+import torch
+from torch import nn
+
+MODES = ('eager', 'script', 'compile')
+
+
+def enable_persistent_cache(cache_dir='data/compile-cache'):
+    """Store `torch.compile` artifacts (generated kernels and FX graphs) under `cache_dir`.
+
+    Must be called before the first compilation in the process.
+    """
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+    return cache_dir
+
+
+def compile_unsupported():
+    """None if `torch.compile` can be used here, otherwise the reason why not."""
+    if not hasattr(torch, 'compile'):
+        return f'torch.compile needs PyTorch 2.0 or later, this is {torch.__version__}'
+    import torch._dynamo
+    is_supported = getattr(torch._dynamo, 'is_dynamo_supported', None)
+    if is_supported is not None and not is_supported():
+        return 'torch.compile is not supported on this platform or Python version'
+    return None
+
+
+class LossModule(nn.Module):
+    """Model followed by the loss function, so both can be traced or compiled together."""
+
+    def __init__(self, model, loss_fn):
+        super(LossModule, self).__init__()
+        self.model = model
+        self.loss_fn = loss_fn
+
+    def forward(self, X, y):
+        return self.loss_fn(self.model(X), y)
+
+
+def make_train_step(model, loss_fn, optimizer, mode='compile', fallback=True):
+    """Return `step(X, y)` that runs one optimization step and returns the (detached) loss.
+
+    With `fallback`, the `'compile'` mode prints why and uses the eager step
+    when `torch.compile` is unsupported or fails on the first call; otherwise
+    the error is raised.
+    """
+    if mode not in MODES:
+        raise ValueError(f'mode must be one of {MODES}, got {mode!r}')
+    loss_module = LossModule(model, loss_fn)
+    forward = loss_module if mode != 'script' else None
+
+    def step(X, y):
+        nonlocal forward
+        if forward is None:
+            # TorchScript needs example inputs, so the model is traced on the first batch.
+            forward = torch.jit.trace(loss_module, (X, y))
+        optimizer.zero_grad(set_to_none=True)
+        loss = forward(X, y)
+        loss.backward()
+        optimizer.step()
+        return loss.detach()
+
+    if mode != 'compile':
+        return step
+    reason = compile_unsupported()
+    if reason is not None:
+        if not fallback:
+            raise RuntimeError(reason)
+        print(f'{reason}; using the eager step instead')
+        return step
+    compiled = torch.compile(step)
+    if not fallback:
+        return compiled
+    chosen = None
+
+    def step_with_fallback(X, y):
+        nonlocal chosen
+        if chosen is not None:
+            return chosen(X, y)
+        try:
+            loss = compiled(X, y)
+        except Exception as e:
+            # torch.compile compiles on the first call, so a missing compiler or backend shows up here.
+            print(f'torch.compile failed ({type(e).__name__}: {e}); using the eager step instead')
+            chosen = step
+            return step(X, y)
+        chosen = compiled
+        return loss
+
+    return step_with_fallback
+
+
+def warm_up(step, model, optimizer, dataloader, steps=3):
+    """Run a few steps so that tracing or compilation happens now, then restore the weights.
+
+    Model and optimizer state are saved before and loaded back afterwards, so the
+    warm-up does not change the training result.
+    """
+    model_state = copy.deepcopy(model.state_dict())
+    optimizer_state = copy.deepcopy(optimizer.state_dict())
+    begin = time.perf_counter()
+    batches = iter(dataloader)
+    for _ in range(steps):
+        X, y = next(batches)
+        step(X, y)
+    model.load_state_dict(model_state)
+    optimizer.load_state_dict(optimizer_state)
+    return time.perf_counter() - begin
+
+
+def benchmark(model, loss_fn, make_optimizer, dataloader, steps=200, modes=MODES, warmup_steps=3):
+    """Train a copy of `model` for `steps` steps in each mode and print steps per second.
+
+    `make_optimizer` is called with the parameters of each copy, for example
+    `lambda params: torch.optim.SGD(params, lr=1e-3)`. The `'compile'` mode is
+    skipped, with a message, where `torch.compile` is unsupported or fails.
+    """
+    batches = []
+    for X, y in dataloader:
+        batches.append((X, y))
+        if len(batches) == steps:
+            break
+
+    results = {}
+    for mode in modes:
+        reason = compile_unsupported() if mode == 'compile' else None
+        if reason is not None:
+            print(f'Skipping mode {mode!r}: {reason}')
+            continue
+        candidate = copy.deepcopy(model)
+        optimizer = make_optimizer(candidate.parameters())
+        step = make_train_step(candidate, loss_fn, optimizer, mode, fallback=False)
+        try:
+            warmup_time = warm_up(step, candidate, optimizer, batches, warmup_steps)
+        except Exception as e:
+            if mode != 'compile':
+                raise
+            print(f'Skipping mode {mode!r}: torch.compile failed ({type(e).__name__}: {e})')
+            continue
+        begin = time.perf_counter()
+        for X, y in batches:
+            loss = step(X, y)
+        loss.item()
+        elapsed = time.perf_counter() - begin
+        results[mode] = {'steps_per_sec': len(batches) / elapsed, 'warmup_sec': warmup_time}
+
+    if not results:
+        return results
+    baseline = results.get('eager', next(iter(results.values())))['steps_per_sec']
+    print(f"{'mode':<10}{'steps/sec':>12}{'speedup':>10}{'warm-up sec':>14}")
+    for mode, r in results.items():
+        print(f"{mode:<10}{r['steps_per_sec']:>12.1f}{r['steps_per_sec'] / baseline:>9.2f}x{r['warmup_sec']:>14.2f}")
+    return results
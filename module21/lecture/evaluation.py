@@ -0,0 +1,64 @@
+"""Evaluation loop that keeps its running totals on the device.
+
+Calling `.item()` on every batch forces the device to finish all queued work
+and copies a scalar back to Python. `evaluate` instead adds the loss sum and
+a confusion matrix up as tensors on the device and reads them back once, at
+the end of the pass. It runs under `torch.inference_mode()`, and can re-batch
+the loader with a larger batch size, since no gradients are kept.
+
+The same file is used by the module21 and module22 notebooks.
+"""
+import torch
+
+
+def rebatch(loader, batch_size):
+    """Return a loader over the same dataset as `loader` with a different batch size, in sequential order.
+
+    Wrappers that keep the original loader as `.loader`, such as `EpochTimer`,
+    are unwrapped first. A `DataLoader` is rebuilt with the same workers,
+    memory pinning and collate function; other loaders, such as `BatchLoader`,
+    must accept `(dataset, batch_size=...)`.
+    """
+    while hasattr(loader, 'loader'):
+        loader = loader.loader
+    if not isinstance(loader, torch.utils.data.DataLoader):
+        return type(loader)(loader.dataset, batch_size=batch_size)
+    settings = {'num_workers': loader.num_workers, 'collate_fn': loader.collate_fn,
+                'pin_memory': loader.pin_memory, 'timeout': loader.timeout,
+                'worker_init_fn': loader.worker_init_fn,
+                'multiprocessing_context': loader.multiprocessing_context}
+    if loader.num_workers > 0:
+        settings['prefetch_factor'] = loader.prefetch_factor
+    return torch.utils.data.DataLoader(loader.dataset, batch_size=batch_size, **settings)
+
+
+def evaluate(model, loader, loss_fn, num_classes=10, device='cpu', batch_size=None):
+    """Evaluate `model` on `loader`.
+
+    Returns a dictionary with the average loss per item, the accuracy, the number
+    of items, and the confusion matrix (rows are true classes, columns are
+    predicted classes) as a CPU tensor. `loss_fn` is expected to average over the
+    batch, like the default `reduction='mean'` of PyTorch losses.
+    """
+    if batch_size is not None:
+        loader = rebatch(loader, batch_size)
+    was_training = model.training
+    model.eval()
+    loss_sum = torch.zeros((), device=device)
+    confusion = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+    with torch.inference_mode():
+        for X, y in loader:
+            X, y = X.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            pred = model(X)
+            loss_sum += loss_fn(pred, y) * y.shape[0]
+            confusion += torch.bincount(y * num_classes + pred.argmax(1), minlength=num_classes * num_classes)
+    model.train(was_training)
+
+    confusion = confusion.view(num_classes, num_classes).cpu()
+    count = int(confusion.sum())
+    return {
+        'loss': loss_sum.item() / max(count, 1),
+        'accuracy': int(confusion.diag().sum()) / max(count, 1),
+        'count': count,
+        'confusion': confusion,
+    }
@@ -0,0 +1,89 @@
+"""DataLoader settings derived from the machine, and a timer that tells whether an
+epoch was bound by data loading or by compute.
+
+The same file is used by the module21 and module22 notebooks.
+"""
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def loader_settings(num_workers=None, max_workers=8):
+    """Pick `DataLoader` keyword arguments for this machine.
+
+    One core is left to the training loop, the rest (up to `max_workers`) decode
+    and transform samples in worker processes. Workers are kept alive between
+    epochs, and memory is pinned only when batches are copied to a GPU.
+    """
+    if num_workers is None:
+        num_workers = max(0, min(available_cores() - 1, max_workers))
+    settings = {'num_workers': num_workers, 'pin_memory': torch.cuda.is_available()}
+    if num_workers > 0:
+        settings['persistent_workers'] = True
+        # Few workers need a deeper queue to hide a slow sample; many workers already overlap enough.
+        settings['prefetch_factor'] = 4 if num_workers < 4 else 2
+    return settings
+
+
+def make_loader(dataset, batch_size, shuffle=False, **overrides):
+    """Create a `DataLoader` using `loader_settings()`; keyword arguments override the defaults."""
+    settings = loader_settings(overrides.pop('num_workers', None))
+    settings.update(overrides)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **settings)
+
+
+class EpochTimer:
+    """Wraps a loader and splits each epoch's wall time into data loading and compute.
+
+    Time spent waiting for the next batch counts as data loading; time between
+    receiving a batch and asking for the next one counts as compute. Pass
+    `sync_cuda=True` when training on GPU, so that asynchronous kernels are
+    included in the compute time.
+    """
+
+    def __init__(self, loader, sync_cuda=False):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.data_time, self.compute_time, self.batches = 0.0, 0.0, 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.data_time, self.compute_time, self.batches = 0.0, 0.0, 0
+        batches = iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            received = time.perf_counter()
+            self.data_time += received - start
+            yield batch
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            self.compute_time += time.perf_counter() - received
+            self.batches += 1
+
+    @property
+    def data_fraction(self):
+        total = self.data_time + self.compute_time
+        return self.data_time / total if total > 0 else 0.0
+
+    @property
+    def bound_by(self):
+        return 'data loading' if self.data_fraction > 0.5 else 'compute'
+
+    def report(self):
+        return (f"{self.batches} batches: data loading {self.data_time:.2f}s ({100 * self.data_fraction:.0f}%), "
+                f"compute {self.compute_time:.2f}s -> bound by {self.bound_by}")
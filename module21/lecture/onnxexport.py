@@ -0,0 +1,73 @@
+"""ONNX export with a dynamic batch dimension, offline graph optimization,
+dynamic INT8 quantization, and an FP32 vs. INT8 comparison on a test set.
+"""
+import os
+import time
+
+import numpy as np
+import onnxruntime
+import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+
+
+def export_dynamic(model, path, item_shape=(28, 28), opset_version=17):
+    """Export `model` so that the first (batch) dimension of its input and output can have any size."""
+    model.eval()
+    torch.onnx.export(model, torch.zeros((1,) + tuple(item_shape)), path,
+                      input_names=['input'], output_names=['logits'],
+                      dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+                      opset_version=opset_version)
+    return path
+
+
+def optimize(path, optimized_path, level=onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED):
+    """Run ONNX Runtime graph optimizations once and save the optimized graph to `optimized_path`.
+
+    The saved graph may contain ONNX Runtime specific fused operators, so it is
+    meant to be run with ONNX Runtime on the same kind of machine.
+    """
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = level
+    options.optimized_model_filepath = optimized_path
+    onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    return optimized_path
+
+
+def quantize_int8(path, quantized_path):
+    """Quantize the weights of `path` to INT8; activations are quantized on the fly at run time."""
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+def evaluate(path, images, labels, batch_size=256):
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    input_name = session.get_inputs()[0].name
+    session.run(None, {input_name: images[:batch_size]})  # warm-up
+
+    correct, timings = 0, []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        begin = time.perf_counter()
+        logits = session.run(None, {input_name: batch})[0]
+        timings.append((time.perf_counter() - begin) / len(batch))
+        correct += int((logits.argmax(1) == labels[start:start + batch_size]).sum())
+
+    timings = np.array(timings) * 1e6
+    return {
+        'accuracy': correct / len(images),
+        'latency_us_per_image_p50': float(np.percentile(timings, 50)),
+        'latency_us_per_image_p99': float(np.percentile(timings, 99)),
+        'size_kb': os.path.getsize(path) / 1024,
+    }
+
+
+def compare(models, images, labels, batch_size=256):
+    """Evaluate each `{name: path}` in `models` and print a table; returns the results by name."""
+    images = np.ascontiguousarray(images, dtype=np.float32)
+    labels = np.asarray(labels)
+    results = {name: evaluate(path, images, labels, batch_size) for name, path in models.items()}
+    print(f"{'model':<16}{'accuracy':>10}{'p50 us/img':>12}{'p99 us/img':>12}{'size KB':>10}")
+    for name, r in results.items():
+        print(f"{name:<16}{100 * r['accuracy']:>9.2f}%{r['latency_us_per_image_p50']:>12.1f}"
+              f"{r['latency_us_per_image_p99']:>12.1f}{r['size_kb']:>10.0f}")
+    return results
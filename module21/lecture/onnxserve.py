@@ -0,0 +1,138 @@
+"""Local ONNX Runtime inference service with dynamic micro-batching.
+
+Requests from any number of threads are queued. A single worker thread takes
+the first waiting request, collects more requests until `max_batch_size` is
+reached or `max_wait_ms` has passed, copies them into a preallocated input
+buffer and runs the `InferenceSession` once for the whole batch. When only one
+request is waiting the server does not wait for others, so an idle server
+answers with batch size 1 and no added latency.
+"""
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import onnxruntime
+
+
+class InferenceServer:
+    def __init__(self, model_path, max_batch_size=32, max_wait_ms=2.0, num_threads=None, history=10000):
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.output_name = self.session.get_outputs()[0].name
+        self.item_shape = tuple(model_input.shape[1:])
+
+        # A model exported with a fixed batch dimension can only serve one item per run.
+        fixed_batch = model_input.shape[0]
+        self.max_batch_size = fixed_batch if isinstance(fixed_batch, int) else max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.buffer = np.empty((self.max_batch_size,) + self.item_shape, dtype=np.float32)
+
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.completed = 0
+        self.started = time.perf_counter()
+        self.stats_lock = threading.Lock()
+
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, x):
+        """Queue one input item and return a `Future` with the model output for it."""
+        future = Future()
+        self.requests.put((np.asarray(x, dtype=np.float32).reshape(self.item_shape), future, time.perf_counter()))
+        return future
+
+    def predict(self, x):
+        return self.submit(x).result()
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        if batch[0] is None:
+            return None
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if self.requests.empty() and len(batch) == 1:
+                break
+            try:
+                request = self.requests.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            # Requests cancelled while they were waiting are dropped; the others can no longer be cancelled.
+            batch = [request for request in batch if request[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            n = len(batch)
+            for i, (x, _, _) in enumerate(batch):
+                self.buffer[i] = x
+            try:
+                output = self.session.run([self.output_name], {self.input_name: self.buffer[:n]})[0]
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            for i, (_, future, _) in enumerate(batch):
+                future.set_result(output[i].copy())
+            with self.stats_lock:
+                self.latencies.extend(done - submitted for _, _, submitted in batch)
+                self.batch_sizes.append(n)
+                self.completed += n
+
+    def stats(self):
+        # The worker thread keeps appending while the statistics are computed, so work on copies.
+        with self.stats_lock:
+            latencies, batch_sizes = list(self.latencies), list(self.batch_sizes)
+            completed, started = self.completed, self.started
+        latencies = np.array(latencies) * 1000 if latencies else np.zeros(1)
+        elapsed = time.perf_counter() - started
+        return {
+            'requests': completed,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'throughput_per_sec': completed / elapsed if elapsed > 0 else 0.0,
+            'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+        }
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.latencies.clear()
+            self.batch_sizes.clear()
+            self.completed = 0
+            self.started = time.perf_counter()
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_test(server, images, concurrency=16):
+    """Send `images` to `server` from `concurrency` client threads and return `server.stats()`."""
+    server.reset_stats()
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        list(clients.map(server.predict, images))
+    return server.stats()
@@ -0,0 +1,158 @@
+"""Pre-normalized FashionMNIST tensors cached on disk.
+
+`datasets.FashionMNIST(transform=ToTensor())` converts every sample from PIL to a
+float tensor on every epoch. `CachedFashionMNIST` does that conversion once for the
+whole split, stores the result in a small versioned binary file next to the raw
+data, and `BatchLoader` serves batches by slicing the contiguous tensor.
+
+Cache file layout (little endian):
+
+    magic (8 bytes) | version (uint32) | header length (uint32) | JSON header
+    | padding to 64 bytes | images (float32, N x 1 x 28 x 28) | labels (int64, N)
+"""
+import gzip
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+
+CACHE_MAGIC = b'FMNISTTC'
+CACHE_VERSION = 1
+ALIGNMENT = 64
+
+RAW_FILES = {
+    True: ('train-images-idx3-ubyte', 'train-labels-idx1-ubyte'),
+    False: ('t10k-images-idx3-ubyte', 't10k-labels-idx1-ubyte'),
+}
+
+
+def raw_path(root, name):
+    path = os.path.join(root, 'FashionMNIST', 'raw', name)
+    if os.path.exists(path):
+        return path
+    if os.path.exists(path + '.gz'):
+        return path + '.gz'
+    raise FileNotFoundError(f'{path} not found, download the dataset with datasets.FashionMNIST(download=True) first')
+
+
+def read_idx(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        data = f.read()
+    zero, dtype_code, ndim = struct.unpack('>HBB', data[:4])
+    if zero != 0 or dtype_code != 0x08:
+        raise ValueError(f'{path} is not an unsigned byte IDX file')
+    shape = struct.unpack('>' + 'I' * ndim, data[4:4 + 4 * ndim])
+    return np.frombuffer(data, np.uint8, offset=4 + 4 * ndim).reshape(shape)
+
+
+def fingerprint(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return {'size': os.path.getsize(path), 'sha1': sha1.hexdigest()}
+
+
+def build_cache(root, train, cache_path):
+    names = RAW_FILES[train]
+    image_file, label_file = (raw_path(root, name) for name in names)
+    images = torch.from_numpy(read_idx(image_file).copy()).float().div_(255).unsqueeze_(1)
+    labels = torch.from_numpy(read_idx(label_file).astype(np.int64))
+
+    header = json.dumps({
+        'images': list(images.shape),
+        'labels': list(labels.shape),
+        'sources': {name: fingerprint(path) for name, path in zip(names, (image_file, label_file))},
+    }).encode('utf-8')
+    prefix = CACHE_MAGIC + struct.pack('<II', CACHE_VERSION, len(header)) + header
+    prefix += b'\0' * (-len(prefix) % ALIGNMENT)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(prefix)
+        f.write(images.numpy().tobytes())
+        f.write(labels.numpy().tobytes())
+    os.replace(tmp_path, cache_path)
+    return images, labels
+
+
+def read_header(cache_path):
+    with open(cache_path, 'rb') as f:
+        magic = f.read(len(CACHE_MAGIC))
+        version, header_len = struct.unpack('<II', f.read(8))
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            return None, 0
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        offset = f.tell()
+    return header, offset + (-offset % ALIGNMENT)
+
+
+def load_cache(cache_path, root=None, verify=False):
+    """Return (images, labels) from `cache_path`, or None if the cache is missing or stale.
+
+    With `verify=True` the size and SHA-1 of the raw files under `root` are compared
+    with the values recorded when the cache was built.
+    """
+    if not os.path.exists(cache_path):
+        return None
+    header, offset = read_header(cache_path)
+    if header is None:
+        return None
+    if verify:
+        for name, expected in header['sources'].items():
+            if fingerprint(raw_path(root, name)) != expected:
+                return None
+    num_pixels = int(np.prod(header['images']))
+    images = np.fromfile(cache_path, np.float32, count=num_pixels, offset=offset)
+    labels = np.fromfile(cache_path, np.int64, count=header['labels'][0], offset=offset + images.nbytes)
+    return torch.from_numpy(images).view(*header['images']), torch.from_numpy(labels)
+
+
+class CachedFashionMNIST(torch.utils.data.Dataset):
+    """FashionMNIST split held as one normalized float32 tensor of shape (N, 1, 28, 28)."""
+
+    def __init__(self, root='data', train=True, verify=False, rebuild=False):
+        split = 'train' if train else 'test'
+        self.cache_path = os.path.join(root, 'FashionMNIST', 'cached', f'{split}-v{CACHE_VERSION}.bin')
+        cached = None if rebuild else load_cache(self.cache_path, root, verify)
+        self.data, self.targets = cached if cached is not None else build_cache(root, train, self.cache_path)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        return self.data[index], self.targets[index]
+
+
+class BatchLoader:
+    """Drop-in replacement for `DataLoader` over a `CachedFashionMNIST` dataset.
+
+    Batches are slices of the cached tensor, so no per-sample Python code runs.
+    With `shuffle=True` the tensor is permuted once per epoch and then sliced.
+    """
+
+    def __init__(self, dataset, batch_size=64, shuffle=False, drop_last=False, generator=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        data, targets = self.dataset.data, self.dataset.targets
+        if self.shuffle:
+            order = torch.randperm(len(targets), generator=self.generator)
+            data, targets = data[order], targets[order]
+        for i in range(len(self)):
+            start = i * self.batch_size
+            yield data[start:start + self.batch_size], targets[start:start + self.batch_size]
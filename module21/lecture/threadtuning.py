@@ -0,0 +1,135 @@
+"""Pick the number of PyTorch threads for training a model on this machine.
+
+By default PyTorch uses one thread per core for its operators. When
+`DataLoader` worker processes decode and transform samples at the same time,
+the two compete for the same cores, and for small models the overhead of
+splitting every operation across many threads can outweigh the gain anyway.
+`tune_threads` trains a copy of the model for a few steps with different
+numbers of threads, reading batches from the real data loader so that its
+workers are running too, and keeps the fastest setting. The result is stored
+per host and model in `data/thread-settings.json`, so later runs (and other
+notebooks training the same model) apply it immediately without measuring.
+
+Only the intra-op pool (`torch.set_num_threads`) is tuned. PyTorch uses its
+inter-op pool only for TorchScript `fork`, and its size can't be changed once
+it has been used.
+
+The same file is used by the module21 and module22 notebooks.
+"""
+import copy
+import hashlib
+import json
+import os
+import platform
+import time
+
+import torch
+
+from loaders import available_cores
+
+SETTINGS_PATH = 'data/thread-settings.json'
+
+
+def host_key():
+    return f'{platform.node()}-{available_cores()}cores'
+
+
+def model_key(model, batch_size, num_workers):
+    """Name of a tuning result: the model's class and parameter shapes, the batch size and the number of workers."""
+    sha1 = hashlib.sha1()
+    for name, p in model.named_parameters():
+        sha1.update(f'{name}:{tuple(p.shape)}:{p.requires_grad};'.encode('utf-8'))
+    return f'{type(model).__name__}-{sha1.hexdigest()[:8]}-b{batch_size}-w{num_workers}'
+
+
+def read_settings(path=SETTINGS_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_settings(settings, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(settings, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def candidate_threads(num_workers=0):
+    """Powers of two up to the cores left over by the data loading workers, and that number itself."""
+    budget = max(1, available_cores() - num_workers)
+    candidates = {budget}
+    n = 1
+    while n < budget:
+        candidates.add(n)
+        n *= 2
+    return sorted(candidates)
+
+
+def _batches(dataloader):
+    while True:
+        for batch in dataloader:
+            yield batch
+
+
+def _samples_per_sec(model, loss_fn, optimizer, batches, steps, warmup_steps, device):
+    for _ in range(warmup_steps):
+        X, y = next(batches)
+        optimizer.zero_grad()
+        loss_fn(model(X.to(device)), y.to(device)).backward()
+        optimizer.step()
+    count, begin = 0, time.perf_counter()
+    for _ in range(steps):
+        # Waiting for the next batch is included, since that's where the workers compete with the loop.
+        X, y = next(batches)
+        optimizer.zero_grad()
+        loss = loss_fn(model(X.to(device)), y.to(device))
+        loss.backward()
+        optimizer.step()
+        loss.item()
+        count += len(X)
+    return count / (time.perf_counter() - begin)
+
+
+def apply_threads(setting):
+    torch.set_num_threads(setting['num_threads'])
+
+
+def tune_threads(model, loss_fn, dataloader, steps=20, warmup_steps=3, candidates=None,
+                 path=SETTINGS_PATH, retune=False, device='cpu'):
+    """Apply the best number of threads for training `model` with `dataloader`, measuring it if it isn't known yet.
+
+    The model itself is not changed: the trial steps train a copy of it.
+    Returns the setting, a dict with `num_threads` and the measured samples/sec.
+    """
+    num_workers = getattr(dataloader, 'num_workers', 0)
+    host, key = host_key(), model_key(model, dataloader.batch_size, num_workers)
+    settings = read_settings(path)
+    setting = settings.get(host, {}).get(key)
+    if setting is not None and not retune:
+        apply_threads(setting)
+        print(f"Using {setting['num_threads']} threads for {key} (tuned on {setting['tuned']})")
+        return setting
+
+    trial = copy.deepcopy(model).to(device)
+    trial.train()
+    optimizer = torch.optim.SGD([p for p in trial.parameters() if p.requires_grad], lr=1e-3)
+    batches = _batches(dataloader)
+    results = {}
+    for num_threads in candidates or candidate_threads(num_workers):
+        torch.set_num_threads(num_threads)
+        results[num_threads] = _samples_per_sec(trial, loss_fn, optimizer, batches, steps, warmup_steps, device)
+        print(f'{num_threads:3d} threads: {results[num_threads]:8.0f} samples/sec')
+    del batches
+
+    best = max(results, key=results.get)
+    setting = {'num_threads': best, 'samples_per_sec': {str(n): round(s, 1) for n, s in results.items()},
+               'tuned': time.strftime('%Y-%m-%d %H:%M')}
+    settings = read_settings(path)
+    settings.setdefault(host, {})[key] = setting
+    _write_settings(settings, path)
+    apply_threads(setting)
+    print(f'Using {best} threads for {key} ({num_workers} data loading workers, {available_cores()} cores)')
+    return setting
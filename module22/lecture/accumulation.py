@@ -0,0 +1,151 @@
+"""Fine-tuning with large effective batches in a bounded amount of memory.
+
+Two techniques reduce the memory needed for a training step:
+ - *gradient accumulation* splits each batch into micro-batches, and adds
+   their gradients up before a single optimizer step, so that only one
+   micro-batch of activations is kept at a time;
+ - *activation checkpointing* keeps only the outputs of whole blocks of
+   layers during the forward pass, and recomputes the activations inside a
+   block when the backward pass reaches it.
+
+`micro_batch_size` estimates how many images fit into a memory budget, and
+`train_accumulated` trains with any effective batch size using micro-batches
+of that size.
+"""
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+from evaluation import evaluate
+
+
+class CheckpointedSequential(nn.Sequential):
+    """`nn.Sequential` that checkpoints its blocks during training.
+
+    The layers keep their names, so the state dict of the model does not change.
+    By default a block ends after each `MaxPool2d` layer, which splits
+    `vgg.features` into its five convolutional blocks.
+    """
+
+    def __init__(self, sequential, block_ends=None):
+        super(CheckpointedSequential, self).__init__(sequential._modules)
+        if block_ends is None:
+            block_ends = [i + 1 for i, layer in enumerate(self) if isinstance(layer, nn.MaxPool2d)]
+        if not block_ends or block_ends[-1] != len(self):
+            block_ends = list(block_ends) + [len(self)]
+        self.block_ends = block_ends
+
+    def blocks(self):
+        start = 0
+        for end in self.block_ends:
+            yield self[start:end]
+            start = end
+
+    def forward(self, x):
+        if not (self.training and torch.is_grad_enabled()):
+            return super(CheckpointedSequential, self).forward(x)
+        for block in self.blocks():
+            x = checkpoint(block, x, use_reentrant=False)
+        return x
+
+
+def enable_checkpointing(model, name='features'):
+    """Replace the `nn.Sequential` submodule `name` of `model` with a `CheckpointedSequential`."""
+    layers = getattr(model, name)
+    if not isinstance(layers, CheckpointedSequential):
+        setattr(model, name, CheckpointedSequential(layers))
+    return model
+
+
+def _activation_bytes(model, input_shape, device):
+    """Bytes of activations one image keeps for the backward pass, with and without checkpointing."""
+    outputs = {}
+
+    def record(module, inputs, output):
+        if isinstance(output, torch.Tensor):
+            outputs[module] = output.numel() * output.element_size()
+
+    hooks = [m.register_forward_hook(record) for m in model.modules() if not list(m.children())]
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.zeros((1,) + tuple(input_shape), device=device))
+    model.train(was_training)
+    for hook in hooks:
+        hook.remove()
+
+    total = sum(outputs.values())
+    checkpointed = [m for m in model.modules() if isinstance(m, CheckpointedSequential)]
+    if not checkpointed:
+        return total
+    # Only block outputs are stored; the largest block is recomputed in full during the backward pass.
+    for sequential in checkpointed:
+        blocks = [sum(outputs.get(layer, 0) for layer in block) for block in sequential.blocks()]
+        boundaries = sum(outputs.get(block[-1], 0) for block in sequential.blocks())
+        total += boundaries + max(blocks) - sum(blocks)
+    return total
+
+
+def micro_batch_size(model, input_shape=(3, 224, 224), memory_budget_mb=4096, optimizer_slots=2,
+                     safety=2.0, device='cpu', max_size=256):
+    """Largest micro-batch whose training step should fit into `memory_budget_mb`.
+
+    The estimate counts the weights, their gradients and `optimizer_slots`
+    values per trainable parameter (2 for Adam, 1 for SGD with momentum), plus
+    the activations of one image times `safety`, to leave room for temporary
+    buffers of the backward pass.
+    """
+    params = list(model.parameters())
+    weights = sum(p.numel() * p.element_size() for p in params)
+    trainable = sum(p.numel() * p.element_size() for p in params if p.requires_grad)
+    fixed = weights + trainable * (1 + optimizer_slots)
+    per_image = _activation_bytes(model, input_shape, device) * safety
+    available = memory_budget_mb * 1024 * 1024 - fixed
+    if available < per_image:
+        raise ValueError(f'a memory budget of {memory_budget_mb} MB is too small: the weights and optimizer state '
+                         f'need {fixed / 2**20:.0f} MB and one image needs {per_image / 2**20:.0f} MB')
+    return int(min(max_size, available // per_image))
+
+
+def train_accumulated(net, train_loader, test_loader, micro_batch_size, optimizer=None, lr=0.01,
+                      loss_fn=nn.NLLLoss(), epochs=5, print_freq=10, device='cpu', manager=None, save_every=50):
+    """Train like `train_long`, splitting each batch of `train_loader` into micro-batches.
+
+    The batch size of `train_loader` is the effective batch size: gradients of
+    all micro-batches of a batch are added up before one optimizer step, so the
+    result is the same as training with the whole batch at once (up to batch
+    normalization statistics, which VGG does not use).
+
+    With a `CheckpointManager` as `manager`, training resumes from its latest
+    checkpoint and saves a new one every `save_every` batches and at the end of
+    each epoch. `train_loader` must then use a `ResumableSampler`.
+    """
+    optimizer = optimizer or torch.optim.Adam(net.parameters(), lr=lr)
+    sampler = train_loader.sampler
+    start_epoch = manager.restore(net, optimizer, sampler, map_location=device) if manager is not None else 0
+    for epoch in range(start_epoch, epochs):
+        if manager is not None:
+            sampler.set_epoch(epoch)
+        net.train()
+        total_loss, acc, count = 0, 0, 0
+        for i, (features, labels) in enumerate(train_loader):
+            features, labels = features.to(device), labels.to(device)
+            optimizer.zero_grad(set_to_none=True)
+            for X, y in zip(features.split(micro_batch_size), labels.split(micro_batch_size)):
+                out = net(X)
+                # Weight each micro-batch by its share of the batch, so the summed gradient is the batch mean.
+                loss = loss_fn(out, y) * (len(y) / len(labels))
+                loss.backward()
+                total_loss += loss.detach() * len(labels)
+                acc += (out.detach().argmax(1) == y).sum()
+            optimizer.step()
+            count += len(labels)
+            if manager is not None and (i + 1) % save_every == 0:
+                manager.save(net, optimizer, sampler, items_done=(i + 1) * train_loader.batch_size)
+            if i % print_freq == 0:
+                print("Epoch {}, minibatch {}: train acc = {}, train loss = {}".format(
+                    epoch, i, acc.item() / count, total_loss.item() / count))
+        if manager is not None:
+            manager.save(net, optimizer, sampler, items_done=len(sampler))
+        result = evaluate(net, test_loader, loss_fn, num_classes=2, device=device)
+        print("Epoch {} done, validation acc = {}, validation loss = {}".format(epoch, result['accuracy'], result['loss']))
@@ -0,0 +1,166 @@
+"""Periodic, atomic checkpoints that let a training run resume exactly where it stopped.
+
+A checkpoint holds the model and optimizer state, the random number generator
+states, and the position in the training data: the epoch and the number of
+items of that epoch already trained on. `ResumableSampler` makes the order of
+the items depend only on a seed and the epoch, so that a resumed run sees the
+same items in the same order as an uninterrupted one.
+
+`CheckpointManager.save` copies the state to CPU memory on the calling thread
+and writes it to disk on a background thread, so training continues while the
+file is written. Each file is written under a temporary name and renamed when
+complete, so an interrupted write never replaces a good checkpoint. Only the
+last `keep_last` checkpoints are kept.
+
+The same file is used by the module21 and module22 notebooks.
+"""
+import glob
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableSampler(Sampler):
+    """Sampler whose order is fixed by `seed` and the epoch, and that can start in the middle of an epoch."""
+
+    def __init__(self, data_source, shuffle=True, seed=0):
+        self.num_items = len(data_source)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        # Keep the start position when resuming into the same epoch.
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.start = 0
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.num_items, generator=generator)
+        else:
+            order = torch.arange(self.num_items)
+        return iter(order[self.start:].tolist())
+
+    def __len__(self):
+        return self.num_items - self.start
+
+    def state_dict(self, items_done=0):
+        """Position after `items_done` more items of the current epoch have been trained on."""
+        return {'seed': self.seed, 'epoch': self.epoch, 'start': self.start + items_done}
+
+    def load_state_dict(self, state):
+        self.seed, self.epoch, self.start = state['seed'], state['epoch'], state['start']
+        if self.start >= self.num_items:
+            self.epoch, self.start = self.epoch + 1, 0
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'python': random.getstate(), 'numpy': np.random.get_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _to_cpu(value):
+    """Copy tensors (also inside dictionaries and lists) to CPU memory, so that training can keep changing them."""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {k: _to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(v) for v in value)
+    return value
+
+
+class CheckpointManager:
+    def __init__(self, directory, keep_last=3, prefix='checkpoint'):
+        if keep_last < 1:
+            raise ValueError(f'keep_last must be at least 1, got {keep_last}')
+        self.directory = directory
+        self.keep_last = keep_last
+        self.prefix = prefix
+        os.makedirs(directory, exist_ok=True)
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def checkpoints(self):
+        """Paths of the complete checkpoints, oldest first."""
+        return sorted(glob.glob(os.path.join(self.directory, f'{self.prefix}-*.pt')))
+
+    def latest(self):
+        paths = self.checkpoints()
+        return paths[-1] if paths else None
+
+    def save(self, model, optimizer, sampler, items_done=0, **extra):
+        """Queue a checkpoint after `items_done` items of the sampler's current epoch.
+
+        Waits for the previous write to finish first, so at most one copy of the
+        state is waiting to be written. Returns a `Future` for the written path.
+        """
+        position = sampler.state_dict(items_done)
+        state = {
+            'model': _to_cpu(model.state_dict()),
+            'optimizer': _to_cpu(optimizer.state_dict()),
+            'sampler': position,
+            'rng': rng_state(),
+            'extra': extra,
+        }
+        name = f"{self.prefix}-e{position['epoch']:04d}-i{position['start']:09d}.pt"
+        self.wait()
+        self.pending = self.writer.submit(self._write, state, os.path.join(self.directory, name))
+        return self.pending
+
+    def _write(self, state, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        for old_path in self.checkpoints()[:-self.keep_last]:
+            os.remove(old_path)
+        return path
+
+    def wait(self):
+        """Block until the last queued checkpoint is on disk (re-raises a failed write)."""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def restore(self, model, optimizer, sampler, path=None, map_location='cpu'):
+        """Load the latest (or the given) checkpoint; returns the epoch to continue with, 0 if there is none."""
+        path = path or self.latest()
+        if path is None:
+            return 0
+        state = torch.load(path, map_location=map_location, weights_only=False)
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        sampler.load_state_dict(state['sampler'])
+        set_rng_state(state['rng'])
+        print(f"Resuming from {path}: epoch {sampler.epoch + 1}, item {sampler.start}")
+        return sampler.epoch
+
+    def close(self):
+        self.wait()
+        self.writer.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
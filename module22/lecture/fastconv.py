@@ -0,0 +1,181 @@
+"""Channels-last memory layout and fused convolutions for the CNNs on the CPU.
+
+PyTorch stores images as NCHW: each channel is a separate plane. The oneDNN
+convolution kernels that PyTorch uses on x86 CPUs work best on NHWC
+("channels last"), where the values of all channels of a pixel are next to
+each other; with NCHW tensors, they convert the input and output of every
+convolution. `ChannelsLast` converts the weights of a model and its inputs to
+channels last once, so the layout stays the same from layer to layer.
+
+Fusion removes the passes over memory between layers, for example a ReLU
+that reads and writes the whole output of the convolution before it:
+
+* for inference, `fuse_for_inference` traces the model with TorchScript,
+  freezes the weights into the graph and lets `optimize_for_inference` replace
+  convolutions followed by ReLU with a single fused oneDNN operation;
+* for training, `compile_for_training` uses `torch.compile`, which generates
+  code that applies ReLU and pooling directly to the output of the convolution.
+
+`check_outputs` and `check_gradients` verify that an optimized model computes
+the same outputs and gradients as the original within floating point
+tolerance, and `benchmark` compares the speed of each variant.
+
+In channels-last layout, the output of a convolution is not contiguous in the
+usual NCHW order, so models must flatten it with `torch.flatten` or `reshape`
+rather than `view`.
+"""
+import copy
+import time
+
+import torch
+from torch import nn
+
+
+def channels_last(x):
+    """`x` in channels-last memory layout if it is a batch of images; other tensors are returned unchanged."""
+    return x.contiguous(memory_format=torch.channels_last) if x.dim() == 4 else x
+
+
+class ChannelsLast(nn.Module):
+    """Runs `model` with its weights and its input in channels-last layout.
+
+    The model is converted in place, so it can be trained with this wrapper
+    and used as before afterwards. The layout doesn't change any results.
+    """
+
+    def __init__(self, model):
+        super(ChannelsLast, self).__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        return self.model(channels_last(x))
+
+
+def fuse_for_inference(model, example_input):
+    """Frozen TorchScript version of `model` for inference, in channels-last layout, with Conv+ReLU fused.
+
+    `example_input` is a batch with the shape the model will be used with.
+    The original model is not changed. The returned module can't be trained.
+    """
+    model = copy.deepcopy(model).eval().to(memory_format=torch.channels_last)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, channels_last(example_input))
+        fused = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        fused(channels_last(example_input))  # the first calls run the optimization passes
+        fused(channels_last(example_input))
+    return _ChannelsLastScript(fused)
+
+
+class _ChannelsLastScript(nn.Module):
+    def __init__(self, script):
+        super(_ChannelsLastScript, self).__init__()
+        self.script = script
+
+    def forward(self, x):
+        return self.script(channels_last(x))
+
+
+def compile_for_training(model, mode=None):
+    """`model` in channels-last layout, compiled with `torch.compile` so that Conv+ReLU(+pool) are fused.
+
+    The parameters are shared with `model`, so training the returned module trains `model`.
+    """
+    if not hasattr(torch, 'compile'):
+        raise RuntimeError(f'torch.compile needs PyTorch 2.0 or later, this is {torch.__version__}')
+    return torch.compile(ChannelsLast(model), mode=mode)
+
+
+def check_outputs(reference, candidate, x, rtol=1e-4, atol=1e-4):
+    """Compare the outputs of two models in evaluation mode; returns the largest absolute difference."""
+    reference.eval()
+    candidate.eval()
+    with torch.no_grad():
+        expected, actual = reference(x), candidate(x)
+    torch.testing.assert_close(actual.float(), expected.float(), rtol=rtol, atol=atol)
+    return (actual.float() - expected.float()).abs().max().item()
+
+
+def check_gradients(reference, make_candidate, x, y, loss_fn, rtol=1e-4, atol=1e-4):
+    """Compare the gradients of one training step of `reference` and of `make_candidate(copy)`.
+
+    Both start from the same weights. Returns the largest absolute difference of
+    any gradient.
+    """
+    copy_model = copy.deepcopy(reference)
+    candidate = make_candidate(copy_model)
+    largest = 0.0
+    for model, module in ((reference, reference), (candidate, copy_model)):
+        module.train()
+        module.zero_grad()
+        loss_fn(model(x), y).backward()
+    for (name, expected), (_, actual) in zip(reference.named_parameters(), copy_model.named_parameters()):
+        if expected.grad is None:
+            continue
+        torch.testing.assert_close(actual.grad, expected.grad, rtol=rtol, atol=atol, msg=lambda m: f'{name}: {m}')
+        largest = max(largest, (actual.grad - expected.grad).abs().max().item())
+    reference.zero_grad()
+    return largest
+
+
+def _time(fn, steps, warmup_steps):
+    for _ in range(warmup_steps):
+        fn()
+    begin = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return (time.perf_counter() - begin) / steps
+
+
+def benchmark(models, shapes, loss_fn=nn.CrossEntropyLoss(), steps=50, warmup_steps=5, num_classes=10):
+    """Time inference and training of each model in `models` (name -> model) for the input shape in `shapes`.
+
+    `shapes` maps the same names to batch shapes, for example `(64, 1, 28, 28)`
+    for MNIST or `(64, 3, 32, 32)` for CIFAR-10. Inference compares the
+    original model, channels last, and channels last with fused Conv+ReLU;
+    training compares the original model, channels last, and channels last
+    with `torch.compile`. Each variant is checked against the original first.
+    Where `torch.compile` doesn't work (for example on Windows with PyTorch
+    2.0), the compiled variant is skipped. Returns the milliseconds per batch
+    of each variant.
+    """
+    results = {}
+    for name, model in models.items():
+        x = torch.rand(shapes[name])
+        y = torch.randint(0, num_classes, (shapes[name][0],))
+        model = copy.deepcopy(model)
+
+        inference = {'reference': model, 'channels_last': ChannelsLast(copy.deepcopy(model)),
+                     'fused': fuse_for_inference(model, x)}
+        for variant, candidate in inference.items():
+            check_outputs(model, candidate, x)
+            with torch.no_grad():
+                seconds = _time(lambda: candidate(x), steps, warmup_steps)
+            results[(name, 'inference', variant)] = 1000 * seconds
+
+        training = {'reference': lambda m: m, 'channels_last': ChannelsLast, 'compiled': compile_for_training}
+        for variant, make_candidate in training.items():
+            try:
+                check_gradients(model, make_candidate, x, y, loss_fn)
+            except AssertionError:
+                raise
+            except Exception as e:
+                if variant != 'compiled':
+                    raise
+                print(f'{name}: torch.compile is not available here, skipping it ({type(e).__name__}: {e})')
+                continue
+            candidate = make_candidate(copy.deepcopy(model)).train()
+            optimizer = torch.optim.SGD(candidate.parameters(), lr=1e-3)
+
+            def step():
+                optimizer.zero_grad()
+                loss = loss_fn(candidate(x), y)
+                loss.backward()
+                optimizer.step()
+                return loss.item()
+            results[(name, 'training', variant)] = 1000 * _time(step, steps, warmup_steps)
+
+    print(f"{'model':<16}{'pass':<11}{'variant':<15}{'ms/batch':>10}{'speedup':>9}")
+    for (name, phase, variant), ms in results.items():
+        speedup = results[(name, phase, 'reference')] / ms
+        print(f'{name:<16}{phase:<11}{variant:<15}{ms:>10.2f}{speedup:>8.2f}x')
+    return results
@@ -0,0 +1,116 @@
+"""Resumable on-disk store for features extracted by a frozen network.
+
+Features are written in chunks of `chunk_size` rows under a directory named
+after a hash of the extractor's weights, so features from different weights
+never mix. Each chunk is a `.npy` array (optionally float16) plus a `.json`
+file with the image path and label of every row; the `.json` file is written
+last, so a chunk interrupted halfway is simply extracted again. Images whose
+path is already in the store are skipped, which makes `extract_features`
+resumable.
+"""
+import bisect
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+from loaders import make_loader
+
+
+def weights_key(module):
+    sha1 = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        sha1.update(name.encode('utf-8'))
+        sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()[:16]
+
+
+def _save_atomic(path, write):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class FeatureStore:
+    def __init__(self, root, key, dim, dtype=np.float16, chunk_size=2048):
+        self.dtype = np.dtype(dtype)
+        self.directory = os.path.join(root, f'{key}-{self.dtype.name}')
+        self.dim = dim
+        self.chunk_size = chunk_size
+        os.makedirs(self.directory, exist_ok=True)
+        self.features, self.paths, self.labels = [], [], []
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('chunk-') and name.endswith('.json'):
+                with open(os.path.join(self.directory, name)) as f:
+                    meta = json.load(f)
+                self.features.append(np.load(os.path.join(self.directory, meta['features']), mmap_mode='r'))
+                self.paths.append(meta['paths'])
+                self.labels.append(meta['labels'])
+        self.done = {path for paths in self.paths for path in paths}
+        self.offsets = list(np.cumsum([0] + [len(paths) for paths in self.paths]))
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def append(self, features, paths, labels):
+        if len(paths) == 0:
+            return
+        features = np.asarray(features, dtype=self.dtype).reshape(len(paths), self.dim)
+        name = f'chunk-{len(self.paths):05d}'
+        _save_atomic(os.path.join(self.directory, name + '.npy'), lambda f: np.save(f, features))
+        meta = {'features': name + '.npy', 'paths': list(paths), 'labels': [int(l) for l in labels]}
+        _save_atomic(os.path.join(self.directory, name + '.json'), lambda f: f.write(json.dumps(meta).encode('utf-8')))
+        self.features.append(np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r'))
+        self.paths.append(meta['paths'])
+        self.labels.append(meta['labels'])
+        self.done.update(paths)
+        self.offsets.append(self.offsets[-1] + len(paths))
+
+    def dataset(self):
+        return FeatureDataset(self)
+
+
+class FeatureDataset(torch.utils.data.Dataset):
+    """Rows of a `FeatureStore` as `(float32 feature vector, label)` pairs."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        chunk = bisect.bisect_right(self.store.offsets, i) - 1
+        row = i - self.store.offsets[chunk]
+        features = torch.from_numpy(np.asarray(self.store.features[chunk][row], dtype=np.float32))
+        return features, self.store.labels[chunk][row]
+
+
+def extract_features(extractor, dataset, store, batch_size=16, device='cpu'):
+    """Run `extractor` over the images of `dataset` that are not in `store` yet.
+
+    `dataset` must have a `samples` list of `(path, label)` pairs in the same order
+    as its items, like `ImageFolder` and `CachedImageFolder`.
+    """
+    pending = [i for i, (path, _) in enumerate(dataset.samples) if path not in store.done]
+    print(f'{len(store)} images already in the store, {len(pending)} to extract')
+    loader = make_loader(torch.utils.data.Subset(dataset, pending), batch_size=batch_size)
+    extractor.eval()
+    features, paths, labels = [], [], []
+    start = 0
+    with torch.inference_mode():
+        for x, y in loader:
+            features.append(extractor(x.to(device)).flatten(1).cpu().numpy().astype(store.dtype))
+            paths.extend(dataset.samples[i][0] for i in pending[start:start + len(y)])
+            labels.extend(y.tolist())
+            start += len(y)
+            if len(paths) >= store.chunk_size:
+                store.append(np.concatenate(features), paths, labels)
+                features, paths, labels = [], [], []
+                print('.', end='')
+    if paths:
+        store.append(np.concatenate(features), paths, labels)
+    print(f'\n{len(store)} images in the store')
@@ -0,0 +1,94 @@
+"""Training only the classifier of a frozen network on cached embeddings.
+
+When every parameter of a network except its classifier is frozen, the part
+before the classifier (the *backbone*) computes the same embedding for an image
+in every epoch. `train_head` detects this case, computes the embeddings of all
+images once with `extract_features` (batched, with data loading workers) and
+keeps them in a `FeatureStore` on disk, and then trains the classifier alone on
+the stored embeddings. Each epoch then costs only the classifier's work.
+
+The backbone runs in evaluation mode, so batch normalization layers use their
+pretrained statistics instead of updating them as `train_long` would.
+"""
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+from evaluation import evaluate
+from featurestore import FeatureStore, extract_features, weights_key
+
+
+def frozen_backbone(model, head='classifier'):
+    """Return the backbone of a MobileNet-style model if it is frozen and its `head` is not, otherwise None.
+
+    The backbone is `model.features` followed by global average pooling, which
+    is what MobileNetV2 computes before its classifier.
+    """
+    head_names = tuple(f'{head}.{name}' for name, _ in getattr(model, head).named_parameters())
+    backbone_trainable = any(p.requires_grad for name, p in model.named_parameters() if name not in head_names)
+    head_trainable = any(p.requires_grad for p in getattr(model, head).parameters())
+    if backbone_trainable or not head_trainable or not hasattr(model, 'features'):
+        return None
+    pool = getattr(model, 'avgpool', nn.AdaptiveAvgPool2d(1))
+    return nn.Sequential(model.features, pool, nn.Flatten())
+
+
+def cached_embeddings(backbone, dataset, root, batch_size=64, device='cpu'):
+    """Embeddings of all images of `dataset` (extracting the missing ones) and their labels, in dataset order."""
+    backbone.eval()
+    with torch.inference_mode():
+        dim = backbone(dataset[0][0].unsqueeze(0).to(device)).shape[1]
+    store = FeatureStore(root, weights_key(backbone), dim=dim, dtype=np.float32)
+    extract_features(backbone, dataset, store, batch_size=batch_size, device=device)
+
+    rows = {path: row for row, path in enumerate(path for paths in store.paths for path in paths)}
+    order = np.array([rows[path] for path, _ in dataset.samples])
+    features = torch.from_numpy(np.concatenate(store.features)[order])
+    labels = torch.tensor(np.concatenate(store.labels)[order], dtype=torch.long)
+    return features, labels
+
+
+def train_head(model, trainset, testset, root='data/embeddings', head='classifier', epochs=10, lr=0.01,
+               optimizer=None, loss_fn=nn.CrossEntropyLoss(), batch_size=64, num_classes=2, device='cpu'):
+    """Train `model.<head>` on cached embeddings of `trainset` and validate on `testset`.
+
+    `trainset` and `testset` are `Subset`s of the same image dataset (as returned
+    by `random_split`), which must have a `samples` list like `ImageFolder`.
+    The head is trained in place, so `model` can be used directly afterwards.
+    Returns the training history like `train` from `pytorchcv`.
+    """
+    backbone = frozen_backbone(model, head)
+    if backbone is None:
+        raise ValueError(f'only `{head}` may be trainable to train on cached embeddings; use train_long instead')
+    head_module = getattr(model, head)
+
+    begin = time.perf_counter()
+    features, labels = cached_embeddings(backbone, trainset.dataset, root, device=device)
+    print(f'Embeddings ready in {time.perf_counter() - begin:.1f} sec')
+    train_ds = torch.utils.data.TensorDataset(features[trainset.indices], labels[trainset.indices])
+    test_ds = torch.utils.data.TensorDataset(features[testset.indices], labels[testset.indices])
+    train_loader = torch.utils.data.DataLoader(train_ds, batch_size=batch_size, shuffle=True)
+    test_loader = torch.utils.data.DataLoader(test_ds, batch_size=batch_size)
+
+    optimizer = optimizer or torch.optim.Adam(head_module.parameters(), lr=lr)
+    res = {'train_loss': [], 'train_acc': [], 'val_loss': [], 'val_acc': []}
+    for epoch in range(epochs):
+        begin = time.perf_counter()
+        head_module.train()
+        for X, y in train_loader:
+            X, y = X.to(device), y.to(device)
+            optimizer.zero_grad()
+            loss = loss_fn(head_module(X), y)
+            loss.backward()
+            optimizer.step()
+        train_result = evaluate(head_module, train_loader, loss_fn, num_classes=num_classes, device=device)
+        val_result = evaluate(head_module, test_loader, loss_fn, num_classes=num_classes, device=device)
+        print(f"Epoch {epoch:2}, Train acc={train_result['accuracy']:.3f}, Val acc={val_result['accuracy']:.3f}, "
+              f"Train loss={train_result['loss']:.3f}, Val loss={val_result['loss']:.3f} ({time.perf_counter() - begin:.1f} sec)")
+        res['train_loss'].append(train_result['loss'])
+        res['train_acc'].append(train_result['accuracy'])
+        res['val_loss'].append(val_result['loss'])
+        res['val_acc'].append(val_result['accuracy'])
+    return res
@@ -0,0 +1,160 @@
+"""Decoded-image cache for `ImageFolder`-style datasets such as `data/PetImages`.
+
+`build_image_cache` decodes every image once, applies `Resize(resize)` and
+`CenterCrop(crop)` in a pool of worker processes, and stores the uint8 pixels in
+one memory-mapped array. `CachedImageFolder` reads the array back, so training
+epochs no longer spend their time in Pillow.
+
+A cache directory contains:
+
+    images.u8   - uint8 array of shape (rows, crop, crop, 3)
+    index.json  - classes, the row, label and source path of every good image,
+                  and a hash of the file list, so the cache is rebuilt when images
+                  are added, changed or removed
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+CACHE_VERSION = 1
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def list_images(root):
+    classes = sorted(d.name for d in os.scandir(root) if d.is_dir())
+    samples = []
+    for label, name in enumerate(classes):
+        folder = os.path.join(root, name)
+        for file in sorted(os.listdir(folder)):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                samples.append((os.path.join(folder, file), label))
+    return classes, samples
+
+
+def files_key(samples):
+    """Hash of the paths, labels, sizes and modification times of `samples`."""
+    sha1 = hashlib.sha1()
+    for path, label in samples:
+        stat = os.stat(path)
+        sha1.update(f'{path}\0{label}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return sha1.hexdigest()[:16]
+
+
+def _decode_chunk(images_path, shape, resize, crop, rows, paths):
+    """Decode `paths` into `rows` of the memory-mapped array; return the rows that failed."""
+    prepare = transforms.Compose([transforms.Resize(resize), transforms.CenterCrop(crop)])
+    images = np.memmap(images_path, np.uint8, mode='r+', shape=shape)
+    failed = []
+    for row, path in zip(rows, paths):
+        try:
+            with Image.open(path) as image:
+                images[row] = np.asarray(prepare(image.convert('RGB')), dtype=np.uint8)
+        except Exception:
+            failed.append(row)
+    images.flush()
+    return failed
+
+
+def read_index(cache_dir):
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        index = json.load(f)
+    return index if index.get('version') == CACHE_VERSION else None
+
+
+def build_image_cache(root, cache_dir, resize=256, crop=224, workers=None, chunk_size=256, rebuild=False):
+    """Build the cache for the image folder `root` unless a matching one exists. Returns the index."""
+    classes, samples = list_images(root)
+    key = files_key(samples)
+    index = None if rebuild else read_index(cache_dir)
+    if (index is not None and index['root'] == root and index['resize'] == resize and index['crop'] == crop
+            and index.get('files') == key):
+        return index
+
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, 'index.json')
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    images_path = os.path.join(cache_dir, 'images.u8')
+    shape = (len(samples), crop, crop, 3)
+    np.memmap(images_path, np.uint8, mode='w+', shape=shape).flush()
+
+    failed = set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = []
+        for start in range(0, len(samples), chunk_size):
+            rows = list(range(start, min(start + chunk_size, len(samples))))
+            paths = [samples[row][0] for row in rows]
+            jobs.append(pool.submit(_decode_chunk, images_path, shape, resize, crop, rows, paths))
+        for job in jobs:
+            failed.update(job.result())
+
+    index = {
+        'version': CACHE_VERSION,
+        'root': root,
+        'resize': resize,
+        'crop': crop,
+        'files': key,
+        'shape': list(shape),
+        'classes': classes,
+        'rows': [row for row in range(len(samples)) if row not in failed],
+        'skipped': sorted(samples[row][0] for row in failed),
+    }
+    index['paths'] = [samples[row][0] for row in index['rows']]
+    index['labels'] = [samples[row][1] for row in index['rows']]
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+class CachedImageFolder(torch.utils.data.Dataset):
+    """Dataset over a cache built by `build_image_cache`.
+
+    Items are `(image, label)` pairs, where `image` is a float tensor of shape
+    (3, crop, crop) with values in [0, 1] (the same as `ToTensor()` would return),
+    passed through `transform` if one is given.
+    """
+
+    def __init__(self, cache_dir, transform=None):
+        self.index = read_index(cache_dir)
+        if self.index is None:
+            raise FileNotFoundError(f'no image cache in {cache_dir}, call build_image_cache first')
+        self.images_path = os.path.join(cache_dir, 'images.u8')
+        self._images, self._pid = None, None
+        self.rows = self.index['rows']
+        self.classes = self.index['classes']
+        self.targets = self.index['labels']
+        self.samples = list(zip(self.index['paths'], self.targets))
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def images(self):
+        # The memory map is opened in every process that reads it, instead of being pickled to the workers.
+        if self._images is None or self._pid != os.getpid():
+            self._images = np.memmap(self.images_path, np.uint8, mode='r', shape=tuple(self.index['shape']))
+            self._pid = os.getpid()
+        return self._images
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_images'], state['_pid'] = None, None
+        return state
+
+    def __getitem__(self, i):
+        image = torch.from_numpy(np.array(self.images[self.rows[i]])).permute(2, 0, 1).float().div_(255)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[i]
@@ -0,0 +1,82 @@
+"""Parallel check for corrupt image files, with a manifest that remembers the results.
+
+`check_image_dir` from the helper modules opens every image one after the
+other, on every run. `scan_images` instead checks the files in a pool of
+worker processes, using `PIL.Image.verify`, which checks the file structure
+without decoding the pixels. The result for each file is stored in a JSON
+manifest together with the file's size and modification time, so later runs
+only check files that are new or have changed.
+
+The same file is used by the module22 and module25 notebooks.
+"""
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+
+def check_image(path):
+    """True if `path` is a readable, structurally valid image."""
+    try:
+        if os.path.getsize(path) == 0:
+            return False
+        with Image.open(path) as image:
+            image.verify()
+        return True
+    except Exception:
+        return False
+
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def read_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest_path, manifest):
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def scan_images(patterns, manifest_path, remove=True, workers=None, chunksize=64):
+    """Check all files matching the glob `patterns`; returns the lists of good and bad paths.
+
+    Like `check_image_dir`, corrupt files are deleted when `remove` is True;
+    otherwise they are recorded as bad in the manifest and reported again on
+    every run.
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    manifest = read_manifest(manifest_path)
+
+    fingerprints = {path: _fingerprint(path) for path in paths}
+    unchanged = {path: manifest[path]['ok'] for path in paths
+                 if path in manifest and manifest[path]['fingerprint'] == fingerprints[path]}
+    pending = [path for path in paths if path not in unchanged]
+    print(f'{len(paths)} files, {len(pending)} new or changed')
+
+    results = dict(unchanged)
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results.update(zip(pending, pool.map(check_image, pending, chunksize=chunksize)))
+
+    bad = [path for path in paths if not results[path]]
+    for path in bad:
+        print(f'Corrupt image: {path}')
+        if remove:
+            os.remove(path)
+    manifest = {path: {'ok': results[path], 'fingerprint': fingerprints[path]}
+                for path in paths if not (remove and not results[path])}
+    _write_manifest(manifest_path, manifest)
+    return [path for path in paths if results[path]], bad
@@ -0,0 +1,225 @@
+"""Where does the time go? Per-layer time, FLOPs and activation memory of a PyTorch model.
+
+`LayerProfiler` registers forward and backward hooks on every layer of a model
+and adds up, over any number of training or evaluation steps, the time spent
+in the forward and backward pass of each layer, the floating point operations
+of its forward pass and the size of the activations it produces. `table` shows
+the totals sorted by any column, and `save_trace` writes the individual calls
+as a Chrome trace, which can be opened in `chrome://tracing` or
+https://ui.perfetto.dev to see the layers on a timeline.
+
+The hooks exist only while the profiler is enabled: `disable()` removes them
+from the model, so a disabled profiler costs nothing. Use the profiler as a
+context manager to enable it for a block of code.
+
+Only the leaf modules (the ones without children) are timed, so that the time
+of a layer is not counted again in the containers around it. Time spent
+between layers, for example in `nn.functional` calls inside `forward`, in the
+loss function or in the optimizer, is not attributed to any layer.
+"""
+import json
+import os
+import time
+from collections import defaultdict
+
+import torch
+from torch import nn
+
+TRACE_THREADS = {'forward': 1, 'backward': 2}
+SORT_KEYS = ('total_ms', 'forward_ms', 'backward_ms', 'gflops', 'activation_mb', 'calls')
+
+
+def _tensors(value):
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (tuple, list)):
+        return [t for v in value for t in _tensors(v)]
+    return []
+
+
+def _sync(tensors):
+    if any(t.is_cuda for t in tensors):
+        torch.cuda.synchronize()
+
+
+def forward_flops(module, inputs, output):
+    """Floating point operations of one forward call (a multiply-add counts as two)."""
+    out = output.numel()
+    if isinstance(module, nn.modules.conv._ConvNd):
+        kernel = module.in_channels // module.groups
+        for k in module.kernel_size:
+            kernel *= k
+        return 2 * out * kernel + (out if module.bias is not None else 0)
+    if isinstance(module, nn.Linear):
+        return 2 * out * module.in_features + (out if module.bias is not None else 0)
+    if isinstance(module, (nn.MaxPool2d, nn.AvgPool2d)):
+        kernel = module.kernel_size if isinstance(module.kernel_size, tuple) else (module.kernel_size,) * 2
+        return out * kernel[0] * kernel[1]
+    if isinstance(module, (nn.AdaptiveAvgPool2d, nn.AdaptiveMaxPool2d)):
+        return inputs[0].numel()
+    if isinstance(module, nn.modules.batchnorm._BatchNorm):
+        return 2 * out
+    if isinstance(module, (nn.Flatten, nn.Identity, nn.Dropout)):
+        return 0
+    return out  # activations and other element-wise layers
+
+
+class LayerProfiler:
+    """Per-layer statistics of `model`, collected while the profiler is enabled.
+
+    `max_trace_events` limits the number of calls kept for the Chrome trace;
+    the statistics in the table always cover all calls.
+    """
+
+    def __init__(self, model, enabled=False, max_trace_events=100000):
+        self.model = model
+        self.max_trace_events = max_trace_events
+        self.layers = {module: name for name, module in model.named_modules()
+                       if name and not any(True for _ in module.children())}
+        self.handles = []
+        self._inplace = []
+        self.reset()
+        if enabled:
+            self.enable()
+
+    def reset(self):
+        self.stats = defaultdict(lambda: {'calls': 0, 'forward_s': 0.0, 'backward_s': 0.0,
+                                          'flops': 0, 'activation_bytes': 0, 'max_activation_bytes': 0})
+        self.events = []
+        self._forward_start = {}
+        self._backward_start = {}
+        self._origin = time.perf_counter()
+
+    @property
+    def enabled(self):
+        return bool(self.handles)
+
+    def enable(self):
+        if self.enabled:
+            return self
+        # Backward hooks don't allow the output of a layer to be modified in place by the next one,
+        # so in-place activations are switched off while profiling (the results are the same).
+        self._inplace = [module for module in self.layers if getattr(module, 'inplace', False)]
+        for module in self._inplace:
+            module.inplace = False
+        for module in self.layers:
+            self.handles.append(module.register_forward_pre_hook(self._forward_pre))
+            self.handles.append(module.register_forward_hook(self._forward))
+            self.handles.append(module.register_full_backward_pre_hook(self._backward_pre))
+            self.handles.append(module.register_full_backward_hook(self._backward))
+        return self
+
+    def disable(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        for module in self._inplace:
+            module.inplace = True
+        self._inplace = []
+        return self
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def _event(self, module, phase, begin, end):
+        if len(self.events) < self.max_trace_events:
+            self.events.append({'name': self.layers[module], 'cat': phase, 'ph': 'X', 'pid': os.getpid(),
+                                'tid': TRACE_THREADS[phase], 'ts': (begin - self._origin) * 1e6, 'dur': (end - begin) * 1e6,
+                                'args': {'type': type(module).__name__}})
+
+    def _forward_pre(self, module, inputs):
+        _sync(_tensors(inputs))
+        self._forward_start[module] = time.perf_counter()
+
+    def _forward(self, module, inputs, output):
+        outputs = _tensors(output)
+        _sync(outputs)
+        end = time.perf_counter()
+        begin = self._forward_start.pop(module, end)
+        stats = self.stats[self.layers[module]]
+        stats['calls'] += 1
+        stats['forward_s'] += end - begin
+        if outputs:
+            stats['flops'] += forward_flops(module, _tensors(inputs), outputs[0])
+            size = sum(t.numel() * t.element_size() for t in outputs)
+            stats['activation_bytes'] += size
+            stats['max_activation_bytes'] = max(stats['max_activation_bytes'], size)
+        self._event(module, 'forward', begin, end)
+
+    def _backward_pre(self, module, grad_output):
+        _sync(_tensors(grad_output))
+        self._backward_start[module] = time.perf_counter()
+
+    def _backward(self, module, grad_input, grad_output):
+        _sync(_tensors(grad_input))
+        end = time.perf_counter()
+        begin = self._backward_start.pop(module, end)
+        self.stats[self.layers[module]]['backward_s'] += end - begin
+        self._event(module, 'backward', begin, end)
+
+    def rows(self, sort_by='total_ms'):
+        """Statistics of every layer that was called, as a list of dicts sorted by `sort_by` (descending)."""
+        if sort_by not in SORT_KEYS:
+            raise ValueError(f'sort_by must be one of {SORT_KEYS}')
+        types = {name: type(module).__name__ for module, name in self.layers.items()}
+        rows = []
+        for name, s in self.stats.items():
+            rows.append({'layer': name, 'type': types[name], 'calls': s['calls'],
+                         'forward_ms': 1000 * s['forward_s'], 'backward_ms': 1000 * s['backward_s'],
+                         'total_ms': 1000 * (s['forward_s'] + s['backward_s']), 'gflops': s['flops'] / 1e9,
+                         'activation_mb': s['activation_bytes'] / max(s['calls'], 1) / 2**20,
+                         'max_activation_mb': s['max_activation_bytes'] / 2**20})
+        return sorted(rows, key=lambda row: row[sort_by], reverse=True)
+
+    def table(self, sort_by='total_ms', top=None):
+        """The statistics as a text table; activation sizes are per call."""
+        rows = self.rows(sort_by)[:top]
+        total = sum(row['total_ms'] for row in self.rows()) or 1
+        width = max([len(row['layer']) for row in rows] + [5])
+        lines = [f"{'layer':{width}} {'type':16} {'calls':>6} {'fwd ms':>9} {'bwd ms':>9} {'total ms':>9} {'%':>5} "
+                 f"{'GFLOP':>8} {'GFLOP/s':>8} {'act MB':>8}"]
+        for row in rows:
+            gflops_per_s = row['gflops'] / (row['forward_ms'] / 1000) if row['forward_ms'] else 0
+            lines.append(f"{row['layer']:{width}} {row['type'][:16]:16} {row['calls']:6d} {row['forward_ms']:9.1f} "
+                         f"{row['backward_ms']:9.1f} {row['total_ms']:9.1f} {100 * row['total_ms'] / total:5.1f} "
+                         f"{row['gflops']:8.2f} {gflops_per_s:8.1f} {row['activation_mb']:8.2f}")
+        return '\n'.join(lines)
+
+    def save_trace(self, path):
+        """Write the recorded calls as a Chrome trace (JSON) file."""
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': phase}}
+                     for phase, tid in TRACE_THREADS.items()]
+            json.dump({'traceEvents': names + self.events, 'displayTimeUnit': 'ms'}, f)
+        os.replace(tmp_path, path)
+        return path
+
+
+def profile_training(model, dataloader, loss_fn, optimizer=None, steps=None, device='cpu', trace_path=None):
+    """Train `model` for `steps` batches (or one epoch) with a `LayerProfiler` enabled and return the profiler.
+
+    Without an `optimizer`, the forward and backward passes are profiled but
+    the gradients are discarded, so the weights of a trained model don't change.
+    """
+    profiler = LayerProfiler(model)
+    model.train()
+    with profiler:
+        for i, (X, y) in enumerate(dataloader):
+            if steps is not None and i >= steps:
+                break
+            X, y = X.to(device), y.to(device)
+            if optimizer is not None:
+                optimizer.zero_grad()
+            loss = loss_fn(model(X), y)
+            loss.backward()
+            if optimizer is not None:
+                optimizer.step()
+            else:
+                model.zero_grad(set_to_none=True)
+    if trace_path is not None:
+        profiler.save_trace(trace_path)
+    return profiler
@@ -0,0 +1,162 @@
+"""Mixed-precision (bfloat16) training on the CPU.
+
+`autocast(precision)` returns a context manager that runs the forward pass
+with `torch.autocast`: matrix multiplications and convolutions are computed
+in bfloat16 (or float16), while the weights, the gradients and precision
+sensitive operations such as the loss stay in float32. `MixedPrecision`
+wraps a model so that its forward pass runs under `autocast`, which switches
+an existing training loop such as `train` or `train_long` to mixed precision
+without changing it.
+
+bfloat16 has the same exponent range as float32, so small gradients do not
+underflow and no loss scaling is needed. float16 has a much smaller range and
+needs a `GradScaler`, which `grad_scaler` creates when `precision == 'fp16'`.
+
+`compare_precision` trains each model for a fixed number of steps in each
+precision and reports the throughput and the peak resident memory (RSS) of
+the process.
+
+The same file is used by the module21 and module22 notebooks.
+"""
+import copy
+import itertools
+import sys
+import time
+
+import torch
+from torch import nn
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(precision='bf16', device_type='cpu'):
+    """Context manager for the forward pass and the loss; `'fp32'` disables autocasting."""
+    if precision not in PRECISIONS:
+        raise ValueError(f'precision must be one of {tuple(PRECISIONS)}, got {precision!r}')
+    dtype = PRECISIONS[precision]
+    return torch.autocast(device_type, dtype=dtype or torch.bfloat16, enabled=dtype is not None)
+
+
+class MixedPrecision(nn.Module):
+    """Runs the forward pass of `model` under `autocast(precision)` and returns float32 outputs.
+
+    The backward pass and the optimizer step stay outside of autocasting, as
+    recommended by PyTorch, and the wrapped model is trained in place.
+    """
+
+    def __init__(self, model, precision='bf16', device_type='cpu'):
+        super(MixedPrecision, self).__init__()
+        self.model = model
+        self.precision = precision
+        self.device_type = device_type
+
+    def forward(self, x):
+        with autocast(self.precision, self.device_type):
+            return self.model(x).float()
+
+
+def grad_scaler(precision='bf16', device_type='cpu'):
+    """Loss scaler that is only active for float16, the one precision that needs it.
+
+    `torch.amp.GradScaler` only exists from PyTorch 2.3 on; older versions
+    have the CUDA scaler, which disables itself without a GPU.
+    """
+    enabled = precision == 'fp16'
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def train_step(model, loss_fn, optimizer, X, y, precision='bf16', scaler=None):
+    """One optimization step in `precision`; returns the (detached, float32) loss."""
+    with autocast(precision, X.device.type):
+        loss = loss_fn(model(X), y)
+    optimizer.zero_grad(set_to_none=True)
+    if scaler is not None and scaler.is_enabled():
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    else:
+        loss.backward()
+        optimizer.step()
+    return loss.detach().float()
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process, where the operating system allows it (Linux only).
+
+    Returns False if the peak can't be reset, in which case `peak_rss_mb` returns
+    the peak since the process started.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak RSS of this process in MB, or None where it isn't available (Windows)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _format_rss(peak):
+    return '-' if peak is None else f'{peak:.0f}'
+
+
+def measure(model, loss_fn, optimizer, dataloader, precision='bf16', steps=50, warmup_steps=3, device='cpu'):
+    """Train `model` for `steps` batches of `dataloader` and return images per second and peak RSS."""
+    model.train()
+    scaler = grad_scaler(precision, torch.device(device).type)
+    batches = iter(dataloader)
+    for X, y in itertools.islice(batches, warmup_steps):
+        train_step(model, loss_fn, optimizer, X.to(device), y.to(device), precision, scaler)
+
+    reset_peak_rss()
+    count, loss = 0, None
+    begin = time.perf_counter()
+    for X, y in itertools.islice(batches, steps):
+        loss = train_step(model, loss_fn, optimizer, X.to(device), y.to(device), precision, scaler)
+        count += len(X)
+    if count == 0:
+        raise ValueError(f'the loader has no batches left after {warmup_steps} warm-up steps; '
+                         'use a larger dataset or fewer warm-up steps')
+    loss = loss.item()
+    elapsed = time.perf_counter() - begin
+    return {'images_per_sec': count / elapsed, 'peak_rss_mb': peak_rss_mb(), 'loss': loss}
+
+
+def compare_precision(models, dataloader, loss_fn, make_optimizer, precisions=('fp32', 'bf16'), steps=50, device='cpu'):
+    """Train a copy of each `{name: model}` in each precision and print a table.
+
+    `make_optimizer` is called with the parameters of each copy, for example
+    `lambda params: torch.optim.SGD(params, lr=0.001, momentum=0.9)`. Only
+    parameters with `requires_grad` are passed, so frozen backbones stay frozen.
+    """
+    results = {}
+    for name, model in models.items():
+        for precision in precisions:
+            candidate = copy.deepcopy(model).to(device)
+            optimizer = make_optimizer([p for p in candidate.parameters() if p.requires_grad])
+            results[(name, precision)] = measure(candidate, loss_fn, optimizer, dataloader, precision, steps, device=device)
+            del candidate, optimizer
+
+    print(f"{'model':<20}{'precision':>10}{'images/sec':>12}{'speedup':>9}{'peak RSS MB':>13}")
+    for (name, precision), r in results.items():
+        baseline = results[(name, precisions[0])]['images_per_sec']
+        print(f"{name:<20}{precision:>10}{r['images_per_sec']:>12.1f}{r['images_per_sec'] / baseline:>8.2f}x{_format_rss(r['peak_rss_mb']):>13}")
+    return results
@@ -0,0 +1,129 @@
+"""Post-training static INT8 quantization of the CNN classifiers.
+
+A quantized model stores its weights as 8-bit integers and computes
+convolutions and linear layers in integer arithmetic, so it is about four
+times smaller than the float32 model and usually faster on the CPU. *Static*
+quantization also fixes the scale of every activation in advance: the model
+is run on a few hundred training images (the *calibration*), observers record
+the range of values each layer produces, and these ranges are built into the
+quantized model. No retraining is needed.
+
+`quantize_static` uses PyTorch's FX graph mode quantization, which works on
+the models as they are written in the notebooks, including functional calls
+such as `nn.functional.relu`. Before quantizing, it folds every BatchNorm into
+the convolution before it (in evaluation mode a BatchNorm is just a per
+channel scale and shift) and fuses Conv+ReLU pairs, so they become single
+quantized operations. Operations without an INT8 kernel, such as
+`log_softmax`, stay in float32.
+
+`save_quantized` writes the result as TorchScript, which can be loaded with
+`torch.jit.load` without the model's Python code, and `quantization_report`
+compares accuracy, file size and CPU latency of the float and INT8 models.
+"""
+import copy
+import io
+import os
+import time
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from evaluation import evaluate
+
+
+def quantization_backend():
+    """The best quantized engine of this PyTorch build: x86 (or fbgemm) on Intel/AMD, qnnpack on ARM."""
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError('this PyTorch build has no quantized engine')
+
+
+def calibration_loader(dataset, num_images=300, batch_size=32, seed=0):
+    """Loader over `num_images` random images of `dataset`, for calibration."""
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:num_images].tolist()
+    return torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, indices), batch_size=batch_size)
+
+
+def quantize_static(model, calibration_data, backend=None):
+    """INT8 copy of `model`, calibrated on the batches `(X, y)` of `calibration_data`.
+
+    The original model is not changed. The quantized model runs on the CPU
+    and takes the same float32 inputs as the original.
+    """
+    backend = backend or quantization_backend()
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    example_input = next(iter(calibration_data))[0][:1]
+    # prepare_fx folds BatchNorm into the preceding convolution and fuses Conv+ReLU, then inserts observers.
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs=(example_input,))
+    with torch.inference_mode():
+        for X, _ in calibration_data:
+            prepared(X)
+    return convert_fx(prepared)
+
+
+def save_quantized(model, path, example_input):
+    """Save `model` as TorchScript at `path` (atomically) and return the file size in MB."""
+    with torch.no_grad():
+        scripted = torch.jit.trace(model.eval(), example_input)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.jit.save(scripted, tmp_path)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path) / 2**20
+
+
+def state_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+def latency_ms(model, example_input, runs=100, warmup_runs=10):
+    """Median time of one forward pass on `example_input`, in milliseconds."""
+    times = []
+    with torch.inference_mode():
+        for i in range(warmup_runs + runs):
+            begin = time.perf_counter()
+            model(example_input)
+            if i >= warmup_runs:
+                times.append(time.perf_counter() - begin)
+    return 1000 * sorted(times)[len(times) // 2]
+
+
+def quantization_report(models, test_loader, loss_fn=nn.CrossEntropyLoss(), num_classes=10, directory=None):
+    """Compare float and INT8 models; `models` maps a name to a `(float_model, quantized_model)` pair.
+
+    Accuracy is measured on `test_loader`, latency for one image (as on an
+    inspection PC classifying images one by one) and for one batch of the
+    loader. With `directory`, both models are saved there as TorchScript and
+    the file sizes are reported, otherwise the size of the state dict.
+    """
+    X = next(iter(test_loader))[0]
+    rows = {}
+    for name, (float_model, quantized_model) in models.items():
+        float_model = copy.deepcopy(float_model).cpu().eval()
+        row = {}
+        for kind, model in (('fp32', float_model), ('int8', quantized_model)):
+            result = evaluate(model, test_loader, loss_fn, num_classes=num_classes)
+            if directory is not None:
+                os.makedirs(directory, exist_ok=True)
+                size = save_quantized(model, os.path.join(directory, f'{name}-{kind}.pt'), X[:1])
+            else:
+                size = state_size_mb(model)
+            row[kind] = {'accuracy': result['accuracy'], 'size_mb': size,
+                         'latency_ms': latency_ms(model, X[:1]), 'batch_latency_ms': latency_ms(model, X, runs=20)}
+        rows[name] = row
+
+    print(f"{'model':<20}{'acc fp32':>9}{'acc int8':>9}{'delta':>8}{'MB fp32':>9}{'MB int8':>9}"
+          f"{'ms fp32':>9}{'ms int8':>9}{'speedup':>9}{'batch':>8}")
+    for name, row in rows.items():
+        fp32, int8 = row['fp32'], row['int8']
+        print(f"{name:<20}{fp32['accuracy']:>9.3f}{int8['accuracy']:>9.3f}{int8['accuracy'] - fp32['accuracy']:>+8.3f}"
+              f"{fp32['size_mb']:>9.2f}{int8['size_mb']:>9.2f}{fp32['latency_ms']:>9.2f}{int8['latency_ms']:>9.2f}"
+              f"{fp32['latency_ms'] / int8['latency_ms']:>8.2f}x{fp32['batch_latency_ms'] / int8['batch_latency_ms']:>7.2f}x")
+    return rows
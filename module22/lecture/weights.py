@@ -0,0 +1,112 @@
+"""Loading pretrained weights without holding them in memory twice.
+
+`torch.load` followed by `load_state_dict` first reads the whole checkpoint
+into memory and then copies every tensor into the parameters of the model, so
+that for a moment both copies exist. Here instead:
+ - the model is created on the `meta` device, where parameters have a shape
+   but no memory (`meta_model`);
+ - the checkpoint is memory-mapped (`torch.load(mmap=True)`, or a
+   `.safetensors` file), so its tensors are read from disk only when used and
+   can be shared with the operating system's file cache;
+ - `load_state_dict(assign=True)` makes the mapped tensors the parameters of
+   the model, without copying them;
+ - `prefixes` selects the tensors to load, for example only `features.` when
+   the classifier is going to be replaced anyway.
+
+Memory mapping needs the zip-based format that `torch.save` has used since
+PyTorch 1.6. Older files are converted once by `mmap_compatible`.
+
+`mmap=True` and `assign=True` were added in PyTorch 2.1. With older versions
+the file is read into memory as usual, and the tensors are still assigned to
+the model without copying them.
+"""
+import inspect
+import os
+
+import torch
+from torch import nn
+
+try:
+    from safetensors import safe_open
+except ImportError:
+    safe_open = None
+
+HAS_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+HAS_ASSIGN = 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def meta_model(constructor, *args, **kwargs):
+    """Create a model whose parameters take no memory until weights are assigned to them."""
+    with torch.device('meta'):
+        return constructor(*args, **kwargs)
+
+
+def mmap_compatible(path, converted_path=None):
+    """Return a path to the same weights that `torch.load(mmap=True)` can open, converting once if needed."""
+    if path.endswith('.safetensors') or not HAS_MMAP:
+        return path
+    try:
+        torch.load(path, mmap=True, weights_only=True, map_location='cpu')
+        return path
+    except RuntimeError:
+        pass  # saved in the legacy (non-zip) format
+    converted_path = converted_path or os.path.splitext(path)[0] + '-mmap.pt'
+    if not os.path.exists(converted_path):
+        state = torch.load(path, weights_only=True, map_location='cpu')
+        tmp_path = f'{converted_path}.{os.getpid()}.tmp'
+        torch.save(state, tmp_path)
+        del state
+        os.replace(tmp_path, converted_path)
+    return converted_path
+
+
+def load_state(path, prefixes=None):
+    """Memory-mapped state dict of `path`, restricted to the keys starting with one of `prefixes`."""
+    keep = (lambda key: True) if prefixes is None else (lambda key: key.startswith(tuple(prefixes)))
+    if path.endswith('.safetensors'):
+        if safe_open is None:
+            raise ImportError('loading .safetensors files requires the safetensors package')
+        with safe_open(path, framework='pt', device='cpu') as f:
+            return {key: f.get_tensor(key) for key in f.keys() if keep(key)}
+    if HAS_MMAP:
+        state = torch.load(mmap_compatible(path), mmap=True, weights_only=True, map_location='cpu')
+    else:
+        state = torch.load(path, weights_only=True, map_location='cpu')
+    return {key: value for key, value in state.items() if keep(key)}
+
+
+def _assign(model, state):
+    """`load_state_dict(state, strict=False, assign=True)` for PyTorch before 2.1; returns the unexpected keys."""
+    modules = dict(model.named_modules())
+    unexpected = []
+    for key, value in state.items():
+        module_name, _, name = key.rpartition('.')
+        module = modules.get(module_name)
+        if module is not None and module._parameters.get(name) is not None:
+            module._parameters[name] = nn.Parameter(value, requires_grad=module._parameters[name].requires_grad)
+        elif module is not None and module._buffers.get(name) is not None:
+            module._buffers[name] = value
+        else:
+            unexpected.append(key)
+    return unexpected
+
+
+def load_weights(model, path, prefixes=None, strict=True):
+    """Assign the (selected) weights in `path` to `model` without copying them.
+
+    With `strict=True`, every parameter and buffer of `model` under `prefixes`
+    must be in the file. Parameters outside `prefixes` keep their current
+    values; on a `meta_model` they must be replaced (or loaded) before use.
+    """
+    state = load_state(path, prefixes)
+    if HAS_ASSIGN:
+        unexpected = model.load_state_dict(state, strict=False, assign=True).unexpected_keys
+    else:
+        unexpected = _assign(model, state)
+    if strict:
+        expected = [key for key in model.state_dict()
+                    if prefixes is None or key.startswith(tuple(prefixes))]
+        missing = [key for key in expected if key not in state]
+        if missing or unexpected:
+            raise RuntimeError(f'error loading {path}: missing keys {missing}, unexpected keys {unexpected}')
+    return model
@@ -0,0 +1,148 @@
+"""Parallel, verified and resumable extraction of a zip archive of images.
+
+`ZipFile.extractall` unpacks the members one after the other, and nothing can
+use the data until it has finished. `ShardedExtraction` shuffles the image
+members with a fixed seed, splits them into shards of `shard_size` files and
+extracts the shards in a pool of worker processes. Archives usually store one
+class after the other, so without the shuffle the first shards would contain
+a single class, which is bad for training on them while the rest is extracted. Every member is read completely, which makes `zipfile` check
+its CRC-32, and written under a temporary name that is renamed when complete.
+Finished shards are recorded in a manifest next to the extracted files, so an
+interrupted extraction continues with the missing shards; files already on disk
+are kept only if their size and CRC-32 match the archive. `shards()` yields
+the paths of each shard as soon as it is ready, so that work on the first
+shards can start while the others are still being extracted.
+
+The same file is used by the module22 and module25 notebooks.
+"""
+import json
+import os
+import random
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+
+def image_members(zip_path, prefix=''):
+    """Names of the non-empty image files under `prefix` in the archive, in archive order."""
+    with zipfile.ZipFile(zip_path) as archive:
+        return [info.filename for info in archive.infolist()
+                if info.filename.startswith(prefix) and not info.is_dir() and info.file_size > 0
+                and info.filename.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def _crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def _extract_shard(zip_path, names, dest):
+    paths, bad = [], []
+    with zipfile.ZipFile(zip_path) as archive:
+        for name in names:
+            path = os.path.join(dest, *name.split('/'))
+            info = archive.getinfo(name)
+            if os.path.exists(path) and os.path.getsize(path) == info.file_size and _crc32(path) == info.CRC:
+                paths.append(path)
+                continue
+            try:
+                data = archive.read(name)  # raises BadZipFile if the CRC-32 doesn't match
+            except (zipfile.BadZipFile, OSError):
+                bad.append(name)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            paths.append(path)
+    return paths, bad
+
+
+class ShardedExtraction:
+    def __init__(self, zip_path, dest='data', prefix='', shard_size=1000, workers=None, seed=0):
+        self.zip_path = zip_path
+        self.dest = dest
+        names = image_members(zip_path, prefix)
+        # The manifest refers to shards by index, so the order must be the same on every run.
+        random.Random(seed).shuffle(names)
+        self.shard_names = [names[i:i + shard_size] for i in range(0, len(names), shard_size)]
+        self.layout = [seed, shard_size, len(names)]
+        self.manifest_path = os.path.join(dest, f'.{os.path.basename(zip_path)}-extracted.json')
+        self.bad = []
+        self.ready = {}
+        done = self._read_manifest()
+        for i, names in enumerate(self.shard_names):
+            if str(i) in done:
+                self.ready[i] = [os.path.join(dest, *name.split('/')) for name in names if name not in done[str(i)]]
+
+        pending = [i for i in range(len(self.shard_names)) if i not in self.ready]
+        self.pool = ProcessPoolExecutor(max_workers=workers) if pending else None
+        self.futures = {self.pool.submit(_extract_shard, zip_path, self.shard_names[i], dest): i for i in pending}
+        print(f'{len(self.shard_names)} shards, {len(pending)} to extract')
+
+    def _read_manifest(self):
+        # A manifest written with another seed, shard size or member list describes different shards.
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        return manifest['shards'] if manifest.get('layout') == self.layout else {}
+
+    def _record(self, i, bad):
+        # The manifest maps each finished shard to its members that failed verification.
+        done = self._read_manifest()
+        done[str(i)] = bad
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'layout': self.layout, 'shards': done}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def shards(self):
+        """Yield the list of extracted paths of each shard: finished shards first, then the others as they finish.
+
+        If the generator is closed early (or an error occurs), the remaining
+        shards are cancelled and the workers are stopped; a new
+        `ShardedExtraction` of the same archive continues with them.
+        """
+        try:
+            for paths in list(self.ready.values()):
+                yield paths
+            for future in as_completed(list(self.futures)):
+                i = self.futures.pop(future)
+                paths, bad = future.result()
+                for name in bad:
+                    print(f'CRC error, skipped: {name}')
+                self.bad.extend(bad)
+                self._record(i, bad)
+                self.ready[i] = paths
+                yield paths
+        finally:
+            self.close()
+
+    def close(self):
+        """Cancel the shards that haven't started and shut down the worker processes."""
+        for future in self.futures:
+            future.cancel()
+        self.futures = {}
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def wait(self):
+        """Extract everything; returns all extracted paths."""
+        for _ in self.shards():
+            pass
+        return [path for i in sorted(self.ready) for path in self.ready[i]]
+
+
+def extract_parallel(zip_path, dest='data', prefix='', shard_size=1000, workers=None):
+    """Parallel, CRC-verified replacement for `ZipFile(zip_path).extractall(dest)` for the images in the archive."""
+    paths = ShardedExtraction(zip_path, dest, prefix, shard_size, workers).wait()
+    print(f'{len(paths)} images extracted to {dest}')
+    return paths
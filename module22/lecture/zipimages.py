@@ -0,0 +1,136 @@
+"""Image datasets that read straight from a zip archive, or from an extraction in progress.
+
+`ZipImageFolder` works like `torchvision.datasets.ImageFolder`, but reads each
+image from the archive when it is needed, so nothing has to be extracted.
+Each process (including every `DataLoader` worker) opens its own handle on the
+archive. `StreamingImageFolder` is an `IterableDataset` over a
+`ShardedExtraction`: it yields the images of each shard as soon as that shard
+has been extracted, so training can start before the extraction has finished.
+"""
+import io
+import json
+import os
+import random
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from PIL import Image
+
+from zipextract import image_members
+
+
+def _class_of(name, prefix):
+    return name[len(prefix):].split('/')[0]
+
+
+def _corrupt_in(zip_path, names):
+    bad = []
+    with zipfile.ZipFile(zip_path) as archive:
+        for name in names:
+            try:
+                with Image.open(io.BytesIO(archive.read(name))) as image:
+                    image.verify()
+            except Exception:
+                bad.append(name)
+    return bad
+
+
+def corrupt_members(zip_path, prefix='PetImages/', workers=None, chunk_size=500, cache_path=None):
+    """Names of the image members that fail a CRC or `Image.verify` check, checked in parallel.
+
+    With `cache_path`, the result is stored in that file and reused as long as
+    the size and modification time of the archive stay the same.
+    """
+    stat = os.stat(zip_path)
+    fingerprint = [prefix, stat.st_mtime_ns, stat.st_size]
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached['fingerprint'] == fingerprint:
+            return cached['corrupt']
+
+    names = image_members(zip_path, prefix)
+    chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        corrupt = [name for bad in pool.map(_corrupt_in, [zip_path] * len(chunks), chunks) for name in bad]
+    if cache_path is not None:
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'corrupt': corrupt}, f)
+        os.replace(tmp_path, cache_path)
+    return corrupt
+
+
+class ZipImageFolder(torch.utils.data.Dataset):
+    """Images stored as `<prefix><class>/<file>` in a zip archive, labelled by class folder.
+
+    Members listed in `exclude`, for example the result of `corrupt_members`, are left out.
+    """
+
+    def __init__(self, zip_path, prefix='PetImages/', transform=None, exclude=()):
+        self.zip_path = zip_path
+        self.prefix = prefix
+        self.transform = transform
+        exclude = set(exclude)
+        names = [name for name in image_members(zip_path, prefix) if name not in exclude and name.count('/') > prefix.count('/')]
+        self.classes = sorted({_class_of(name, prefix) for name in names})
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.samples = [(name, self.class_to_idx[_class_of(name, prefix)]) for name in names]
+        self.targets = [label for _, label in self.samples]
+        self._archive, self._pid = None, None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _open(self):
+        # A ZipFile handle can't be shared between processes, so every worker opens its own.
+        if self._archive is None or self._pid != os.getpid():
+            self._archive, self._pid = zipfile.ZipFile(self.zip_path), os.getpid()
+        return self._archive
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_archive'], state['_pid'] = None, None
+        return state
+
+    def __getitem__(self, i):
+        name, label = self.samples[i]
+        with Image.open(io.BytesIO(self._open().read(name))) as image:
+            image = image.convert('RGB')
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, label
+
+
+class StreamingImageFolder(torch.utils.data.IterableDataset):
+    """Images of a `ShardedExtraction`, shard by shard as they become available.
+
+    The first epoch follows the order in which shards finish; images are
+    shuffled within each shard when `shuffle` is True. Since the extraction
+    shuffles the members before splitting them into shards, every shard
+    contains images of all classes. Later epochs go over all
+    shards. Files that can't be read (for example corrupt images removed by a
+    scan) are skipped. The extraction runs in the main process, so use the
+    dataset with a `DataLoader` without worker processes (`num_workers=0`).
+    """
+
+    def __init__(self, extraction, classes, transform=None, shuffle=True):
+        self.extraction = extraction
+        self.class_to_idx = {c: i for i, c in enumerate(classes)}
+        self.transform = transform
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        for paths in self.extraction.shards():
+            if self.shuffle:
+                paths = random.sample(paths, len(paths))
+            for path in paths:
+                try:
+                    with Image.open(path) as image:
+                        image = image.convert('RGB')
+                except OSError:
+                    continue
+                if self.transform is not None:
+                    image = self.transform(image)
+                yield image, self.class_to_idx[os.path.basename(os.path.dirname(path))]
@@ -0,0 +1,135 @@
+"""Classify many 28x28 PNG images with the saved Fashion MNIST model.
+
+`predict.ipynb` classifies a single image. This script scores whole
+directories of images offline: the PNG files are read and decoded in parallel
+by a `tf.data` pipeline, which prefetches the next batch while the model works
+on the current one, and each batch goes through the model in a single call.
+Results are written as CSV or JSON Lines while the images are processed, so
+memory use does not grow with the number of images, and the throughput is
+reported as it goes.
+
+Usage:
+
+  python batch_predict.py data/images --output predictions.csv
+  python batch_predict.py 'data/**/*.png' --batch-size 4096 --output predictions.jsonl --probabilities
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from typing import Iterator, List, Optional, Sequence, TextIO
+
+import numpy as np
+import tensorflow as tf
+
+LABELS = ['T-Shirt', 'Trouser', 'Pullover', 'Dress', 'Coat', 'Sandal', 'Shirt', 'Sneaker', 'Bag', 'Ankle Boot']
+
+
+def find_images(inputs: Sequence[str]) -> List[str]:
+  """PNG files in the given directories (searched recursively) or matching the given glob patterns."""
+  paths = set()
+  for pattern in inputs:
+    if os.path.isdir(pattern):
+      pattern = os.path.join(pattern, '**', '*.png')
+    paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+  return sorted(paths)
+
+
+def decode(path: tf.Tensor) -> tf.Tensor:
+  image = tf.io.decode_png(tf.io.read_file(path), channels=1)
+  return tf.cast(tf.reshape(image, (28, 28)), tf.float32) / 255.0
+
+
+def image_batches(paths: Sequence[str], batch_size: int) -> tf.data.Dataset:
+  """Batches of `(paths, images)`; files that are not 28x28 PNG images are left out."""
+  dataset = tf.data.Dataset.from_tensor_slices(list(paths))
+  dataset = dataset.map(lambda path: (path, decode(path)), num_parallel_calls=tf.data.AUTOTUNE)
+  dataset = dataset.apply(tf.data.experimental.ignore_errors())
+  return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def predictions(model: tf.keras.Model, batches: tf.data.Dataset) -> Iterator[tuple]:
+  """Yield `(paths, probabilities)` for each batch."""
+  for paths, images in batches:
+    # predict_on_batch runs the model once on the batch, without the per-call setup of `predict`.
+    logits = model.predict_on_batch(images)
+    probs = tf.nn.softmax(logits).numpy()
+    yield [path.decode('utf-8') for path in paths.numpy()], probs
+
+
+class ResultWriter:
+  """Writes one row per image to `f`, as CSV or JSON Lines."""
+
+  def __init__(self, f: TextIO, output_format: str, probabilities: bool = False):
+    self.f = f
+    self.output_format = output_format
+    self.probabilities = probabilities
+    if output_format == 'csv':
+      self.csv = csv.writer(f)
+      header = ['path', 'index', 'label', 'confidence']
+      self.csv.writerow(header + (LABELS if probabilities else []))
+
+  def write(self, paths: Sequence[str], probs: np.ndarray) -> None:
+    indices = probs.argmax(axis=1)
+    for path, index, p in zip(paths, indices, probs):
+      if self.output_format == 'csv':
+        row = [path, int(index), LABELS[index], f'{p[index]:.4f}']
+        self.csv.writerow(row + ([f'{x:.4f}' for x in p] if self.probabilities else []))
+      else:
+        record = {'path': path, 'index': int(index), 'label': LABELS[index], 'confidence': round(float(p[index]), 4)}
+        if self.probabilities:
+          record['probabilities'] = [round(float(x), 4) for x in p]
+        self.f.write(json.dumps(record) + '\n')
+    self.f.flush()
+
+
+def run(inputs: Sequence[str], model_path: str = 'models', output: str = '-', output_format: Optional[str] = None,
+        batch_size: int = 1024, probabilities: bool = False, report_every: int = 10) -> int:
+  """Classify all images found in `inputs` and write the results to `output` ('-' for stdout).
+
+  Returns the number of images classified.
+  """
+  if output_format is None:
+    output_format = 'jsonl' if output.endswith(('.jsonl', '.json')) else 'csv'
+  paths = find_images(inputs)
+  print(f'{len(paths)} images found', file=sys.stderr)
+  model = tf.keras.models.load_model(model_path)
+
+  f = sys.stdout if output == '-' else open(output, 'w', newline='')
+  try:
+    writer = ResultWriter(f, output_format, probabilities)
+    count, begin = 0, time.perf_counter()
+    for batch_index, (batch_paths, probs) in enumerate(predictions(model, image_batches(paths, batch_size))):
+      writer.write(batch_paths, probs)
+      count += len(batch_paths)
+      if (batch_index + 1) % report_every == 0:
+        elapsed = time.perf_counter() - begin
+        print(f'{count} images, {count / elapsed:.0f} images/sec', file=sys.stderr)
+  finally:
+    if f is not sys.stdout:
+      f.close()
+
+  elapsed = time.perf_counter() - begin
+  print(f'{count} images classified in {elapsed:.1f} sec ({count / max(elapsed, 1e-9):.0f} images/sec), '
+        f'{len(paths) - count} skipped', file=sys.stderr)
+  return count
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+  parser = argparse.ArgumentParser(description='Classify 28x28 Fashion MNIST PNG images with a saved Keras model.')
+  parser.add_argument('inputs', nargs='+', help='directories (searched recursively for .png files) or glob patterns')
+  parser.add_argument('--model', default='models', help='saved model directory (default: models)')
+  parser.add_argument('--output', default='-', help='output file, .csv or .jsonl (default: CSV on stdout)')
+  parser.add_argument('--format', choices=['csv', 'jsonl'], help='output format (default: from the output file name)')
+  parser.add_argument('--batch-size', type=int, default=1024, help='images per model call (default: 1024)')
+  parser.add_argument('--probabilities', action='store_true', help='also write the probability of every class')
+  parser.add_argument('--report-every', type=int, default=10, help='report throughput every N batches (default: 10)')
+  args = parser.parse_args(argv)
+  run(args.inputs, args.model, args.output, args.format, args.batch_size, args.probabilities, args.report_every)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,121 @@
+"""Compute the features of a frozen network once and store them as sharded TFRecord files.
+
+`dataset.map(lambda x,y: (vgg(x),y))` is lazy: VGG runs again every time the
+dataset is iterated, once per epoch for training and once more for validation.
+`extract_embeddings` instead iterates over the dataset once and writes every
+(feature, label) pair to one of `num_shards` TFRecord files. The input
+pipeline decodes the next batches in the background (`prefetch`), while the
+extractor runs on the current batch outside of `tf.data`, so that it can use
+the GPU and all of TensorFlow's threads. An
+`index.json` file written last records the shape, the number of examples and a
+hash of the extractor's weights and of the list of image files; when it
+matches, extraction is skipped.
+`load_embeddings` reads the shards back in parallel.
+"""
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+def weights_key(model):
+    sha1 = hashlib.sha1()
+    for weight in model.weights:
+        sha1.update(weight.name.encode('utf-8'))
+        sha1.update(np.asarray(weight.numpy()).tobytes())
+    return sha1.hexdigest()[:16]
+
+
+def files_key(files):
+    sha1 = hashlib.sha1()
+    for path in files:
+        sha1.update(os.fsencode(path) + b'\0')
+    return sha1.hexdigest()[:16]
+
+
+def read_index(directory):
+    path = os.path.join(directory, 'index.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _example(feature, label):
+    return tf.train.Example(features=tf.train.Features(feature={
+        'feature': tf.train.Feature(bytes_list=tf.train.BytesList(value=[feature.tobytes()])),
+        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+    })).SerializeToString()
+
+
+def extract_embeddings(extractor, dataset, directory, num_shards=8, dtype='float16', rebuild=False, files=None):
+    """Write `extractor(x)` for every batch `(x, y)` of `dataset` to `num_shards` TFRecord files in `directory`.
+
+    The dataset is iterated exactly once, so it may shuffle; batches are
+    distributed over the shards in turn. `files` lists the images the dataset
+    is made of; it defaults to `dataset.file_paths`, which datasets created by
+    `image_dataset_from_directory` have. Returns the index.
+    """
+    files = getattr(dataset, 'file_paths', None) if files is None else files
+    key = weights_key(extractor) if files is None else f'{weights_key(extractor)}-{files_key(files)}'
+    index = read_index(directory)
+    if index is not None and index['key'] == key and not rebuild:
+        print(f"{index['count']} embeddings already in {directory}")
+        return index
+
+    os.makedirs(directory, exist_ok=True)
+    # Only remove what an earlier extraction wrote; the index goes first, so the directory is never half valid.
+    for pattern in ('index.json*', 'shard-*'):
+        for old_path in glob.glob(os.path.join(directory, pattern)):
+            os.remove(old_path)
+    paths = [os.path.join(directory, f'shard-{i:05d}-of-{num_shards:05d}.tfrecord') for i in range(num_shards)]
+    tmp_paths = [f'{path}.{os.getpid()}.tmp' for path in paths]
+    writers = [tf.io.TFRecordWriter(path) for path in tmp_paths]
+
+    count, shape = 0, None
+    for batch_index, (images, y) in enumerate(dataset.prefetch(tf.data.AUTOTUNE)):
+        x = np.asarray(extractor.predict_on_batch(images)).astype(dtype)
+        shape = x.shape[1:]
+        writer = writers[batch_index % num_shards]
+        for feature, label in zip(x, y.numpy()):
+            writer.write(_example(feature, label))
+        count += len(x)
+        if batch_index % 50 == 0:
+            print('.', end='')
+    for writer in writers:
+        writer.close()
+    for tmp_path, path in zip(tmp_paths, paths):
+        os.replace(tmp_path, path)
+
+    index = {'key': key, 'count': count, 'shape': [int(d) for d in shape], 'dtype': dtype,
+             'shards': [os.path.basename(path) for path in paths]}
+    tmp_path = os.path.join(directory, f'index.json.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(directory, 'index.json'))
+    print(f'\n{count} embeddings written to {directory}')
+    return index
+
+
+def load_embeddings(directory, batch_size, shuffle=False, shuffle_buffer=2048, seed=None):
+    """Batched `(float32 feature, label)` dataset of the embeddings in `directory`."""
+    index = read_index(directory)
+    if index is None:
+        raise FileNotFoundError(f'no embeddings in {directory}; run extract_embeddings first')
+    shape, dtype = index['shape'], tf.as_dtype(index['dtype'])
+    spec = {'feature': tf.io.FixedLenFeature([], tf.string), 'label': tf.io.FixedLenFeature([], tf.int64)}
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, spec)
+        feature = tf.reshape(tf.io.decode_raw(example['feature'], dtype), shape)
+        return tf.cast(feature, tf.float32), example['label']
+
+    files = [os.path.join(directory, name) for name in index['shards']]
+    dataset = tf.data.TFRecordDataset(files, num_parallel_reads=tf.data.AUTOTUNE)
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+    dataset = dataset.map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,101 @@
+"""Mixed-precision (bfloat16) training for Keras models on the CPU.
+
+With the `mixed_bfloat16` policy, Keras layers keep their weights in float32
+but compute in bfloat16. The policy has to be set before the model is built,
+which `precision_policy` does for the layers created inside a `with` block.
+The last layer of a model should use `dtype='float32'`, so that the outputs
+and the loss are computed in full precision.
+
+bfloat16 has the same exponent range as float32, so no loss scaling is
+needed. `mixed_float16` does need it: `model.compile` adds it automatically,
+and `loss_scale_optimizer` adds it for custom training loops.
+
+`compare_precision` trains a model for a fixed number of batches with each
+policy and reports the throughput and the peak resident memory (RSS).
+"""
+import sys
+import time
+from contextlib import contextmanager
+
+from tensorflow import keras
+
+POLICIES = ('float32', 'mixed_bfloat16', 'mixed_float16')
+
+
+@contextmanager
+def precision_policy(policy='mixed_bfloat16'):
+    """Build the layers created inside the block with `policy`, then restore the previous policy."""
+    if policy not in POLICIES:
+        raise ValueError(f'policy must be one of {POLICIES}, got {policy!r}')
+    previous = keras.mixed_precision.global_policy()
+    keras.mixed_precision.set_global_policy(policy)
+    try:
+        yield keras.mixed_precision.global_policy()
+    finally:
+        keras.mixed_precision.set_global_policy(previous)
+
+
+def loss_scale_optimizer(optimizer, policy=None):
+    """Wrap `optimizer` in a `LossScaleOptimizer` when the policy computes in float16."""
+    policy = keras.mixed_precision.Policy(policy) if policy else keras.mixed_precision.global_policy()
+    if policy.compute_dtype == 'float16':
+        return keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process, where the operating system allows it (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak RSS of this process in MB, or None where it isn't available (Windows)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _format_rss(peak):
+    return '-' if peak is None else f'{peak:.0f}'
+
+
+def compare_precision(build_model, dataset, batch_size, policies=('float32', 'mixed_bfloat16'), steps=20, warmup_steps=2):
+    """Train a model built by `build_model()` under each policy for `steps` batches and print a table.
+
+    `build_model` must create and compile a new model; it is called inside
+    `precision_policy`, so its layers use the policy being measured.
+    """
+    results = {}
+    for policy in policies:
+        with precision_policy(policy):
+            model = build_model()
+        model.fit(dataset.take(warmup_steps), verbose=0)
+        reset_peak_rss()
+        begin = time.perf_counter()
+        hist = model.fit(dataset.take(steps), verbose=0)
+        elapsed = time.perf_counter() - begin
+        results[policy] = {'images_per_sec': steps * batch_size / elapsed, 'peak_rss_mb': peak_rss_mb(),
+                           'loss': hist.history['loss'][-1]}
+        del model
+
+    baseline = results[policies[0]]['images_per_sec']
+    print(f"{'policy':<16}{'images/sec':>12}{'speedup':>9}{'peak RSS MB':>13}{'loss':>9}")
+    for policy, r in results.items():
+        print(f"{policy:<16}{r['images_per_sec']:>12.1f}{r['images_per_sec'] / baseline:>8.2f}x{_format_rss(r['peak_rss_mb']):>13}{r['loss']:>9.4f}")
+    return results
@@ -0,0 +1,120 @@
+"""Post-training INT8 quantization of Keras classifiers with TensorFlow Lite.
+
+The TensorFlow Lite converter turns a Keras model into a single `.tflite`
+file that runs with the small TFLite interpreter, for example on an
+inspection PC without a full TensorFlow installation. With a representative
+dataset of a few hundred training images, it calibrates the range of every
+activation and converts the weights and the computations to 8-bit integers
+(full integer quantization). The converter folds BatchNorm layers into the
+preceding convolutions and fuses activations such as ReLU into them by itself.
+
+`convert_int8` writes the INT8 model, `convert_float` a float32 TFLite model
+for comparison, and `tflite_report` compares the accuracy, file size and CPU
+latency of the Keras model and its TFLite versions.
+"""
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def representative_dataset(images, num_images=300, seed=0):
+    """Generator function yielding `num_images` random images of `images`, one at a time, for calibration."""
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(images), size=min(num_images, len(images)), replace=False)
+
+    def generate():
+        for i in indices:
+            yield [np.asarray(images[i:i + 1], dtype=np.float32)]
+    return generate
+
+
+def _write(content, path):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return path
+
+
+def convert_float(model, path):
+    """Convert `model` to a float32 TFLite model at `path`."""
+    return _write(tf.lite.TFLiteConverter.from_keras_model(model).convert(), path)
+
+
+def convert_int8(model, images, path, num_images=300, integer_io=False):
+    """Convert `model` to a full integer TFLite model at `path`, calibrated on `num_images` of `images`.
+
+    With `integer_io`, the model also takes int8 inputs and returns int8
+    outputs; otherwise it takes and returns float32 like the Keras model.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(images, num_images)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    if integer_io:
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    return _write(converter.convert(), path)
+
+
+class TFLiteModel:
+    """Runs a `.tflite` file on one image at a time, quantizing inputs and dequantizing outputs if needed."""
+
+    def __init__(self, path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+
+    def __call__(self, image):
+        x = np.asarray(image, dtype=np.float32)[None]
+        scale, zero_point = self.input['quantization']
+        if self.input['dtype'] != np.float32:
+            x = np.round(x / scale + zero_point).astype(self.input['dtype'])
+        self.interpreter.set_tensor(self.input['index'], x)
+        self.interpreter.invoke()
+        y = self.interpreter.get_tensor(self.output['index'])[0]
+        scale, zero_point = self.output['quantization']
+        if self.output['dtype'] != np.float32:
+            y = (y.astype(np.float32) - zero_point) * scale
+        return y
+
+    def predict(self, images):
+        return np.stack([self(image) for image in images])
+
+
+def _latency_ms(predict_one, image, runs=100, warmup_runs=10):
+    times = []
+    for i in range(warmup_runs + runs):
+        begin = time.perf_counter()
+        predict_one(image)
+        if i >= warmup_runs:
+            times.append(time.perf_counter() - begin)
+    return 1000 * sorted(times)[len(times) // 2]
+
+
+def tflite_report(model, tflite_paths, x_test, y_test, num_images=1000):
+    """Compare `model` with its TFLite versions (`tflite_paths` maps a name such as 'int8' to a file).
+
+    Accuracy is measured on the first `num_images` test images and latency
+    for one image at a time. The Keras model's size is that of its weights
+    in float32.
+    """
+    x, y = x_test[:num_images], np.asarray(y_test[:num_images]).reshape(-1)
+    keras_size = sum(np.prod(w.shape) for w in model.weights) * 4 / 2**20
+    keras_accuracy = float(np.mean(np.argmax(model.predict(x, verbose=0), axis=1) == y))
+    predict_one = tf.function(lambda image: model(image[None], training=False))
+    rows = {'keras': {'accuracy': keras_accuracy, 'size_mb': keras_size,
+                      'latency_ms': _latency_ms(lambda image: predict_one(image).numpy(), tf.constant(x[0]))}}
+    for name, path in tflite_paths.items():
+        tflite_model = TFLiteModel(path)
+        rows[name] = {'accuracy': float(np.mean(np.argmax(tflite_model.predict(x), axis=1) == y)),
+                      'size_mb': os.path.getsize(path) / 2**20, 'latency_ms': _latency_ms(tflite_model, x[0])}
+
+    print(f"{'model':<10}{'accuracy':>10}{'delta':>8}{'MB':>8}{'ms/image':>10}")
+    for name, row in rows.items():
+        print(f"{name:<10}{row['accuracy']:>10.3f}{row['accuracy'] - keras_accuracy:>+8.3f}"
+              f"{row['size_mb']:>8.3f}{row['latency_ms']:>10.3f}")
+    return rows
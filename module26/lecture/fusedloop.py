@@ -0,0 +1,163 @@
+"""XLA-compiled training loop that runs several steps per call.
+
+The `fit` function of the lessons calls `.numpy()` on the loss and on the
+accuracy of every batch, so Python waits for each step to finish before it can
+start the next. `FusedTrainer` compiles the training step with
+`jit_compile=True`, runs `steps_per_call` of them inside one `tf.function`
+call, and adds the loss and the number of correct predictions up in
+`tf.Variable` accumulators. The values are only read back when progress is
+printed. `benchmark` compares it with the eager and `@tf.function` versions of
+`fit_one_batch` on the same data and the same initial weights.
+"""
+import time
+from typing import Callable, Dict, Tuple
+
+import tensorflow as tf
+
+
+class FusedTrainer:
+  def __init__(self, model: tf.keras.Model, loss_fn: tf.keras.losses.Loss,
+               optimizer: tf.keras.optimizers.Optimizer, steps_per_call: int = 20, jit_compile: bool = True):
+    self.model = model
+    self.loss_fn = loss_fn
+    self.optimizer = optimizer
+    self.steps_per_call = steps_per_call
+    self.loss_sum = tf.Variable(0.0, trainable=False)
+    self.correct_item_count = tf.Variable(0, dtype=tf.int64, trainable=False)
+    self.item_count = tf.Variable(0, dtype=tf.int64, trainable=False)
+    self.batch_count = tf.Variable(0, dtype=tf.int64, trainable=False)
+    self.last_loss = tf.Variable(0.0, trainable=False)
+    self._train_step = tf.function(self._fit_one_batch, jit_compile=jit_compile, reduce_retracing=True)
+    self._train_steps = tf.function(self._fit_batches)
+
+  def _fit_one_batch(self, X: tf.Tensor, y: tf.Tensor) -> None:
+    with tf.GradientTape() as tape:
+      y_prime = self.model(X, training=True)
+      loss = self.loss_fn(y, y_prime)
+
+    grads = tape.gradient(loss, self.model.trainable_variables)
+    self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
+
+    y = tf.cast(y, tf.int64)
+    self.correct_item_count.assign_add(tf.reduce_sum(tf.cast(tf.math.argmax(y_prime, axis=1) == y, tf.int64)))
+    self.item_count.assign_add(tf.shape(y, out_type=tf.int64)[0])
+    self.batch_count.assign_add(1)
+    self.loss_sum.assign_add(loss)
+    self.last_loss.assign(loss)
+
+  def _fit_batches(self, iterator, steps: tf.Tensor) -> None:
+    for _ in tf.range(steps):
+      (X, y) = next(iterator)
+      self._train_step(X, y)
+
+  def _build(self, dataset: tf.data.Dataset) -> None:
+    # Variables can't be created inside an XLA cluster, so the model and the optimizer are built first.
+    if not self.model.built:
+      (X, _) = next(iter(dataset))
+      self.model(X)
+    if hasattr(self.optimizer, 'build'):
+      self.optimizer.build(self.model.trainable_variables)
+
+  def reset_metrics(self) -> None:
+    for variable in (self.loss_sum, self.correct_item_count, self.item_count, self.batch_count, self.last_loss):
+      variable.assign(tf.zeros_like(variable))
+
+  def fit(self, dataset: tf.data.Dataset, print_every: int = 100, verbose: bool = True) -> Tuple[float, float]:
+    """Train for one epoch over `dataset`; returns the average batch loss and the accuracy."""
+    self._build(dataset)
+    self.reset_metrics()
+    batch_count = len(dataset)
+    iterator = iter(dataset)
+    done = 0
+    while done < batch_count:
+      # Stop each call at the next progress line, so that printing never needs an extra sync.
+      next_report = min((done // print_every + 1) * print_every, batch_count)
+      steps = min(self.steps_per_call, next_report - done)
+      self._train_steps(iterator, tf.constant(steps))
+      done += steps
+      if verbose and done == next_report:
+        current_item_count = int(self.item_count.numpy())
+        batch_accuracy = int(self.correct_item_count.numpy()) / current_item_count * 100
+        print(f'[Batch {done:>3d} - {current_item_count:>5d} items] accuracy: {batch_accuracy:>0.1f}%, loss: {self.last_loss.numpy():>7f}')
+    return self.metrics()
+
+  def metrics(self) -> Tuple[float, float]:
+    average_loss = float(self.loss_sum.numpy()) / max(int(self.batch_count.numpy()), 1)
+    accuracy = int(self.correct_item_count.numpy()) / max(int(self.item_count.numpy()), 1)
+    return (average_loss, accuracy)
+
+
+def make_fit_one_batch(model: tf.keras.Model, loss_fn: tf.keras.losses.Loss,
+                       optimizer: tf.keras.optimizers.Optimizer, graph: bool) -> Callable:
+  """The `fit_one_batch` of the lessons, eager (`train.ipynb`) or wrapped in `@tf.function` (`execution.ipynb`)."""
+  def fit_one_batch(X: tf.Tensor, y: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+    with tf.GradientTape() as tape:
+      y_prime = model(X, training=True)
+      loss = loss_fn(y, y_prime)
+
+    grads = tape.gradient(loss, model.trainable_variables)
+    optimizer.apply_gradients(zip(grads, model.trainable_variables))
+
+    return (y_prime, loss)
+
+  return tf.function(fit_one_batch) if graph else fit_one_batch
+
+
+def fit_per_batch(dataset: tf.data.Dataset, fit_one_batch: Callable) -> Tuple[float, float]:
+  """The `fit` loop of the lessons without the printing: reads the metrics back after every batch."""
+  loss_sum = 0
+  correct_item_count = 0
+  current_item_count = 0
+  batch_count = 0
+  for (X, y) in dataset:
+    (y_prime, loss) = fit_one_batch(X, y)
+
+    y = tf.cast(y, tf.int64)
+    correct_item_count += (tf.math.argmax(y_prime, axis=1) == y).numpy().sum()
+    loss_sum += loss.numpy()
+    current_item_count += len(X)
+    batch_count += 1
+  return (loss_sum / batch_count, correct_item_count / current_item_count)
+
+
+def benchmark(make_model: Callable[[], tf.keras.Model], loss_fn: tf.keras.losses.Loss,
+              make_optimizer: Callable[[], tf.keras.optimizers.Optimizer], dataset: tf.data.Dataset,
+              steps_per_call: int = 20, warmup_batches: int = 5) -> Dict[str, Dict[str, float]]:
+  """Train one epoch of `dataset` with each version of the loop and print a table.
+
+  Every version starts from the same initial weights and first runs
+  `warmup_batches` batches, so that tracing and XLA compilation are not part of
+  the timed epoch.
+  """
+  initial_weights = None
+  results = {}
+  for mode in ('eager', 'tf.function', 'xla'):
+    model = make_model()
+    (X, _) = next(iter(dataset))
+    model(X)
+    if initial_weights is None:
+      initial_weights = model.get_weights()
+    model.set_weights(initial_weights)
+    optimizer = make_optimizer()
+
+    if mode == 'xla':
+      trainer = FusedTrainer(model, loss_fn, optimizer, steps_per_call)
+      trainer.fit(dataset.take(warmup_batches), verbose=False)
+      run = lambda: trainer.fit(dataset, verbose=False)
+    else:
+      fit_one_batch = make_fit_one_batch(model, loss_fn, optimizer, graph=(mode == 'tf.function'))
+      fit_per_batch(dataset.take(warmup_batches), fit_one_batch)
+      run = lambda: fit_per_batch(dataset, fit_one_batch)
+
+    begin = time.perf_counter()
+    (loss, accuracy) = run()
+    elapsed = time.perf_counter() - begin
+    results[mode] = {'sec_per_epoch': elapsed, 'batches_per_sec': len(dataset) / elapsed,
+                     'loss': loss, 'accuracy': accuracy}
+
+  baseline = results['eager']['sec_per_epoch']
+  print(f"{'mode':<14}{'sec/epoch':>11}{'batches/sec':>13}{'speedup':>9}{'accuracy':>10}{'loss':>10}")
+  for mode, r in results.items():
+    print(f"{mode:<14}{r['sec_per_epoch']:>11.2f}{r['batches_per_sec']:>13.1f}{baseline / r['sec_per_epoch']:>8.2f}x"
+          f"{r['accuracy'] * 100:>9.1f}%{r['loss']:>10.4f}")
+  return results
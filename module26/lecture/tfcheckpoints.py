@@ -0,0 +1,80 @@
+"""Periodic checkpoints that let a custom TensorFlow training loop resume exactly where it stopped.
+
+`TrainingCheckpoint` saves the model, the optimizer, the global random number
+generator, the epoch and batch counters, and the state of the `Dataset`
+iterator: the position in the data and the contents of the shuffle buffer.
+A resumed run therefore sees the same batches in the same order as an
+uninterrupted one.
+
+Checkpoints are written with `tf.train.CheckpointManager`, which writes each
+checkpoint completely before recording it as the latest one and keeps only the
+last `keep_last` of them. With `async_write=True` the files are written on a
+background thread while training continues.
+"""
+from typing import Iterator, Optional
+
+import tensorflow as tf
+
+
+class TrainingCheckpoint:
+  def __init__(self, directory: str, model: tf.keras.Model, optimizer: tf.keras.optimizers.Optimizer,
+               keep_last: int = 3, save_every: Optional[int] = 200, async_write: bool = True):
+    self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+    self.batch = tf.Variable(0, dtype=tf.int64, trainable=False)
+    self.save_every = save_every
+    self.checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, epoch=self.epoch, batch=self.batch,
+                                          rng=tf.random.get_global_generator())
+    self.manager = tf.train.CheckpointManager(self.checkpoint, directory, max_to_keep=keep_last)
+    self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=async_write)
+    self.resume_iterator = False
+
+  def restore(self) -> int:
+    """Restore the latest checkpoint, if there is one; returns the epoch to continue with."""
+    path = self.manager.latest_checkpoint
+    if path is None:
+      return 0
+    # Variables of the model and optimizer that don't exist yet are restored when they are created.
+    self.checkpoint.restore(path)
+    self.resume_iterator = int(self.batch.numpy()) > 0
+    print(f'Resuming from {path}: epoch {int(self.epoch.numpy()) + 1}, batch {int(self.batch.numpy())}')
+    return int(self.epoch.numpy())
+
+  def save(self) -> str:
+    return self.manager.save(options=self.options)
+
+  def track(self, dataset: tf.data.Dataset) -> 'TrackedDataset':
+    """Wrap `dataset` so that iterating over it saves checkpoints and advances the counters."""
+    return TrackedDataset(self, dataset)
+
+
+class TrackedDataset:
+  def __init__(self, owner: TrainingCheckpoint, dataset: tf.data.Dataset):
+    self.owner = owner
+    self.dataset = dataset
+
+  def __len__(self) -> int:
+    return len(self.dataset)
+
+  def __iter__(self) -> Iterator:
+    owner = self.owner
+    iterator = iter(self.dataset)
+    owner.checkpoint.iterator = iterator
+    if owner.resume_iterator:
+      # Restoring again now that the new iterator is tracked moves it to the saved position.
+      owner.checkpoint.restore(owner.manager.latest_checkpoint)
+      owner.resume_iterator = False
+    else:
+      owner.batch.assign(0)
+
+    for batch in iterator:
+      yield batch
+      # The caller has trained on the batch when it asks for the next one.
+      owner.batch.assign_add(1)
+      if owner.save_every and int(owner.batch.numpy()) % owner.save_every == 0:
+        owner.save()
+
+    # An exhausted iterator must not be restored into the next epoch, so it is left out of this checkpoint.
+    del owner.checkpoint.iterator
+    owner.epoch.assign_add(1)
+    owner.batch.assign(0)
+    owner.save()
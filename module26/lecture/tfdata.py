@@ -0,0 +1,105 @@
+"""Fashion MNIST input pipeline for the Keras and low-level TensorFlow notebooks.
+
+`get_data` builds the same datasets as the `get_data` function from the
+lessons, but caches the decoded images, shuffles individual images (not whole
+batches), normalizes each batch with one vectorized operation, and prefetches
+batches while the model trains. `StallTimer` measures how long a training loop
+waits for the input pipeline in each epoch.
+
+The same file is used by the module24 and module26 notebooks.
+"""
+import gzip
+import os
+import shutil
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+
+def cache_idx(path: str) -> str:
+  # Decompress the .gz file once, next to the original. Later runs reuse the uncompressed IDX file.
+  raw_path = path[:-len('.gz')] if path.endswith('.gz') else path
+  if not os.path.exists(raw_path):
+    tmp_path = f'{raw_path}.{os.getpid()}.tmp'
+    with gzip.open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+      shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmp_path, raw_path)
+  return raw_path
+
+
+def read_images(path: str, image_size: int, num_items: int, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+  data = np.memmap(cache_idx(path), np.uint8, mode='r', offset=16, shape=(num_items, image_size, image_size))
+  return data[start:stop]
+
+
+def read_labels(path: str, num_items: int, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+  data = np.memmap(cache_idx(path), np.uint8, mode='r', offset=8, shape=(num_items,))
+  return data[start:stop].astype(np.int64)
+
+
+def normalize(images: tf.Tensor, labels: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+  return (tf.cast(images, tf.float32) / 255.0, labels)
+
+
+def get_data(batch_size: int, shuffle_buffer: Optional[int] = None,
+             data_dir: str = 'data/FashionMNIST/raw') -> Tuple[tf.data.Dataset, tf.data.Dataset]:
+  image_size = 28
+  num_train = 60000
+  num_test = 10000
+
+  training_images = read_images(os.path.join(data_dir, 'train-images-idx3-ubyte.gz'), image_size, num_train)
+  test_images = read_images(os.path.join(data_dir, 't10k-images-idx3-ubyte.gz'), image_size, num_test)
+  training_labels = read_labels(os.path.join(data_dir, 'train-labels-idx1-ubyte.gz'), num_train)
+  test_labels = read_labels(os.path.join(data_dir, 't10k-labels-idx1-ubyte.gz'), num_test)
+
+  # Shuffle single images with a buffer as large as the dataset (by default), then batch,
+  # then normalize the whole batch at once.
+  train_dataset = (tf.data.Dataset.from_tensor_slices((training_images, training_labels))
+                   .cache()
+                   .shuffle(shuffle_buffer or num_train)
+                   .batch(batch_size)
+                   .map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
+                   .prefetch(tf.data.AUTOTUNE))
+  test_dataset = (tf.data.Dataset.from_tensor_slices((test_images, test_labels))
+                  .cache()
+                  .batch(batch_size)
+                  .map(normalize, num_parallel_calls=tf.data.AUTOTUNE)
+                  .prefetch(tf.data.AUTOTUNE))
+
+  return (train_dataset, test_dataset)
+
+
+class StallTimer:
+  """Wraps a dataset and measures the time a training loop waits for each batch.
+
+  Use it in place of the dataset in a custom training loop; after each epoch,
+  `report()` tells how much of the epoch was spent waiting for input.
+  """
+
+  def __init__(self, dataset: tf.data.Dataset):
+    self.dataset = dataset
+    self.stall_time = 0.0
+    self.epoch_time = 0.0
+
+  def __len__(self) -> int:
+    return len(self.dataset)
+
+  def __iter__(self):
+    self.stall_time = 0.0
+    begin = time.perf_counter()
+    batches = iter(self.dataset)
+    while True:
+      start = time.perf_counter()
+      try:
+        batch = next(batches)
+      except StopIteration:
+        break
+      self.stall_time += time.perf_counter() - start
+      yield batch
+    self.epoch_time = time.perf_counter() - begin
+
+  def report(self) -> str:
+    share = self.stall_time / self.epoch_time * 100 if self.epoch_time > 0 else 0.0
+    return f'Input pipeline stall: {self.stall_time:.2f} sec of {self.epoch_time:.2f} sec ({share:.1f}%)'
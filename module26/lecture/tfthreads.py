@@ -0,0 +1,156 @@
+"""Pick TensorFlow's intra-op and inter-op thread pool sizes for training a model on this machine.
+
+TensorFlow sizes its thread pools from the number of cores, which can
+oversubscribe the machine when the `tf.data` pipeline or other processes are
+busy at the same time, and small models often train faster with fewer threads.
+The pool sizes can only be set before TensorFlow runs its first operation, so
+`tune_threads` saves the model and trains it for a few steps in a separate
+Python process for every candidate configuration. The fastest configuration is
+stored per host and model name in `data/tf-thread-settings.json`.
+`apply_threads`, called at the start of a notebook before any TensorFlow
+operation has run, applies the stored configuration.
+
+The same file is used by the module24 and module26 notebooks.
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import tensorflow as tf
+
+SETTINGS_PATH = 'data/tf-thread-settings.json'
+
+
+def available_cores() -> int:
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+
+def host_key() -> str:
+  return f'{platform.node()}-{available_cores()}cores'
+
+
+def read_settings(path: str = SETTINGS_PATH) -> Dict:
+  if not os.path.exists(path):
+    return {}
+  with open(path) as f:
+    return json.load(f)
+
+
+def _write_settings(settings: Dict, path: str) -> None:
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  tmp_path = f'{path}.{os.getpid()}.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(settings, f, indent=2)
+  os.replace(tmp_path, path)
+
+
+def candidate_configs() -> List[Tuple[int, int]]:
+  """(intra-op, inter-op) pairs: powers of two up to the number of cores, with 1 or 2 inter-op threads."""
+  cores = available_cores()
+  intra = {cores}
+  n = 1
+  while n < cores:
+    intra.add(n)
+    n *= 2
+  return [(i, j) for i in sorted(intra) for j in (1, 2)]
+
+
+def apply_threads(name: str, path: str = SETTINGS_PATH) -> Optional[Dict]:
+  """Apply the configuration stored for model `name` on this host; returns it, or None if there is none."""
+  setting = read_settings(path).get(host_key(), {}).get(name)
+  if setting is None:
+    print(f'No thread settings for {name} yet, using the defaults')
+    return None
+  try:
+    tf.config.threading.set_intra_op_parallelism_threads(setting['intra_op'])
+    tf.config.threading.set_inter_op_parallelism_threads(setting['inter_op'])
+  except RuntimeError:
+    print('TensorFlow has already started; call apply_threads before running any TensorFlow operation')
+    return None
+  print(f"Using {setting['intra_op']} intra-op and {setting['inter_op']} inter-op threads for {name}")
+  return setting
+
+
+def _trial(model_dir: str, input_shape: Sequence[int], batch_size: int, num_classes: int,
+           steps: int, warmup_steps: int) -> float:
+  # Runs in a new process, after the thread pools have been configured.
+  model = tf.keras.models.load_model(model_dir, compile=False)
+  loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+  optimizer = tf.keras.optimizers.SGD(0.1)
+
+  @tf.function
+  def fit_one_batch(X, y):
+    with tf.GradientTape() as tape:
+      loss = loss_fn(y, model(X, training=True))
+    grads = tape.gradient(loss, model.trainable_variables)
+    optimizer.apply_gradients(zip(grads, model.trainable_variables))
+    return loss
+
+  X = tf.random.uniform((batch_size, *input_shape))
+  y = tf.random.uniform((batch_size,), maxval=num_classes, dtype=tf.int64)
+  for _ in range(warmup_steps):
+    fit_one_batch(X, y).numpy()
+  begin = time.perf_counter()
+  for _ in range(steps):
+    fit_one_batch(X, y).numpy()
+  return batch_size * steps / (time.perf_counter() - begin)
+
+
+def tune_threads(name: str, model: tf.keras.Model, input_shape: Sequence[int], batch_size: int = 64,
+                 num_classes: int = 10, steps: int = 50, warmup_steps: int = 5,
+                 candidates: Optional[List[Tuple[int, int]]] = None, path: str = SETTINGS_PATH,
+                 retune: bool = False) -> Dict:
+  """Find the fastest thread configuration for training `model` (which outputs logits) and store it as `name`.
+
+  A configuration that is already stored for this host is returned without
+  measuring again, unless `retune` is True. The new configuration takes effect
+  the next time `apply_threads(name)` runs in a new process.
+  """
+  host = host_key()
+  setting = read_settings(path).get(host, {}).get(name)
+  if setting is not None and not retune:
+    print(f"{name}: {setting['intra_op']} intra-op and {setting['inter_op']} inter-op threads (tuned on {setting['tuned']})")
+    return setting
+
+  model(tf.zeros((1, *input_shape)))  # make sure the model is built before saving it
+  model_dir = tempfile.mkdtemp()
+  try:
+    model.save(os.path.join(model_dir, 'model'), include_optimizer=False)
+    results = {}
+    for intra_op, inter_op in candidates or candidate_configs():
+      cmd = [sys.executable, os.path.abspath(__file__), os.path.join(model_dir, 'model'),
+             json.dumps({'intra_op': intra_op, 'inter_op': inter_op, 'input_shape': list(input_shape),
+                         'batch_size': batch_size, 'num_classes': num_classes, 'steps': steps,
+                         'warmup_steps': warmup_steps})]
+      env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL='2')
+      proc = subprocess.run(cmd, capture_output=True, text=True, env=env, check=True)
+      results[(intra_op, inter_op)] = float(proc.stdout.strip().splitlines()[-1])
+      print(f'{intra_op:3d} intra-op, {inter_op} inter-op threads: {results[(intra_op, inter_op)]:8.0f} samples/sec')
+  finally:
+    shutil.rmtree(model_dir, ignore_errors=True)
+
+  intra_op, inter_op = max(results, key=results.get)
+  setting = {'intra_op': intra_op, 'inter_op': inter_op,
+             'samples_per_sec': {f'{i}x{j}': round(s, 1) for (i, j), s in results.items()},
+             'tuned': time.strftime('%Y-%m-%d %H:%M')}
+  settings = read_settings(path)
+  settings.setdefault(host, {})[name] = setting
+  _write_settings(settings, path)
+  print(f'{name}: {intra_op} intra-op and {inter_op} inter-op threads; restart the kernel to apply them')
+  return setting
+
+
+if __name__ == '__main__':
+  options = json.loads(sys.argv[2])
+  tf.config.threading.set_intra_op_parallelism_threads(options['intra_op'])
+  tf.config.threading.set_inter_op_parallelism_threads(options['inter_op'])
+  print(_trial(sys.argv[1], options['input_shape'], options['batch_size'], options['num_classes'],
+               options['steps'], options['warmup_steps']))